@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the /proc hot loops of connection_stats.py and fdstats.py against a synthetic /proc tree
+every phase runs in its own interpreter so peak RSS is per phase; results are compared with a stored baseline
+
+bench.py                                 generate a default tree in a temp dir and compare with baseline.json
+bench.py --proc-root DIR                 use an existing tree (see gen_proc_fixture.py)
+bench.py --save-baseline                 store the results as the new baseline
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+### variables
+here = os.path.dirname(os.path.abspath(__file__))
+
+cfg = {} # configuration used in the script
+cfg['repeat'] = 3 # runs per phase, the fastest one is reported
+cfg['tolerance'] = 0.2 # relative throughput drop (or RSS growth) reported as a regression
+cfg['baseline'] = os.path.join(here, "baseline.json")
+cfg['fixture'] = [ "--tcp_rows", "200000", "--tcp6_rows", "20000", "--pids", "2000", "--fds", "50000" ] # arguments for gen_proc_fixture.py
+
+# phase name -> unit of the throughput
+phases = {
+    'connection_stats.parse' : 'rows/s',
+    'connection_stats.inode_index' : 'sockets/s',
+    'fdstats.scan' : 'FDs/s'
+}
+### end variables
+
+### functions
+
+def parse_args ():
+    parser = argparse.ArgumentParser (
+        description = "Benchmarks for connection_stats.py and fdstats.py on a synthetic /proc",
+        usage = "%(prog)s [--proc-root DIR] [--save-baseline]"
+    )
+    parser.add_argument ("--proc-root", help="Existing synthetic /proc tree (default: generate one in a temp dir)")
+    parser.add_argument ("--repeat", type=int, help="Runs per phase, the fastest is reported", default=cfg['repeat'])
+    parser.add_argument ("--baseline", help="Baseline file to compare with (or to save)", default=cfg['baseline'])
+    parser.add_argument ("--save-baseline", help="Store the results as the new baseline", action="store_true", default=False)
+    parser.add_argument ("--tolerance", type=float, help="Relative change reported as a regression", default=cfg['tolerance'])
+    parser.add_argument ("--phase", help=argparse.SUPPRESS) # internal: run a single phase and print its result as JSON
+    return parser.parse_args()
+
+def run_phase (name, proc_root):
+    """ run one phase in this interpreter; returns dict with items processed, wall time and peak RSS """
+    sys.path.insert(0, os.path.dirname(here))
+
+    if name == 'connection_stats.parse':
+        import connection_stats
+        connection_stats.proc_root = proc_root
+        start = time.perf_counter()
+        for proto in [ "tcp", "tcp6", "udp", "udp6" ]:
+            connection_stats.get_stats_proc (proto)
+        wall = time.perf_counter() - start
+        items = sum(sum(s["states"].values()) for s in connection_stats.net_stats.values())
+
+    elif name == 'connection_stats.inode_index':
+        import connection_stats
+        connection_stats.proc_root = proc_root
+        start = time.perf_counter()
+        connection_stats.build_inode_index ()
+        wall = time.perf_counter() - start
+        items = len(connection_stats.inode_index)
+
+    elif name == 'fdstats.scan':
+        import fdstats
+        with fdstats.FDScanner(proc_root = proc_root) as scanner:
+            start = time.perf_counter()
+            snap = scanner.scan ()
+            wall = time.perf_counter() - start
+        items = snap.fd_total
+
+    else:
+        raise ValueError("unknown phase " + name)
+
+    # ru_maxrss is in kilobytes on Linux
+    return { 'items' : items, 'wall' : wall, 'rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss }
+
+def measure (name, proc_root, repeat):
+    """ best of repeat runs, every run in a fresh interpreter """
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([ sys.executable, os.path.abspath(__file__), "--phase", name, "--proc-root", proc_root ],
+                             check=True, capture_output=True, text=True).stdout
+        result = json.loads(out)
+        if best is None or result['wall'] < best['wall']:
+            best = result
+    best['rate'] = best['items'] / best['wall'] if best['wall'] > 0 else 0
+    return best
+
+def compare (name, result, baseline, tolerance):
+    """ change against the baseline, e.g. "rate -3.1% rss +0.5%"; flags regressions """
+    if name not in baseline:
+        return "(no baseline)", False
+    old = baseline[name]
+    rate = (result['rate'] - old['rate']) / old['rate'] if old['rate'] else 0
+    rss = (result['rss_kb'] - old['rss_kb']) / old['rss_kb'] if old['rss_kb'] else 0
+    regression = rate < -tolerance or rss > tolerance
+    return "rate {:+.1%} rss {:+.1%}{}".format(rate, rss, "  REGRESSION" if regression else ""), regression
+
+def print_row (arr):
+    widths = [ 30, 10, 10, 16, 10 ]
+    print ("".join('{:<{}s}'.format(str(v), w) for v, w in zip(arr, widths)) + (arr[5] if len(arr) > 5 else ""))
+
+### end functions
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.phase is not None:
+        print (json.dumps(run_phase(args.phase, args.proc_root)))
+        sys.exit(0)
+
+    tmp_dir = None
+    proc_root = args.proc_root
+    if proc_root is None:
+        tmp_dir = tempfile.mkdtemp(prefix="bench_proc_")
+        proc_root = os.path.join(tmp_dir, "proc")
+        subprocess.run([ sys.executable, os.path.join(here, "gen_proc_fixture.py"), proc_root ] + cfg['fixture'], check=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.save_baseline:
+        print ("No baseline at {}, run with --save-baseline to create one".format(args.baseline))
+
+    results = {}
+    regressions = 0
+    try:
+        print_row([ 'Phase', 'Items', 'Wall (s)', 'Throughput', 'Peak RSS', 'vs baseline' ])
+        for name in phases:
+            results[name] = measure(name, proc_root, args.repeat)
+            r = results[name]
+            change, regression = compare(name, r, baseline, args.tolerance)
+            regressions += regression
+            print_row([ name, r['items'], "{:.3f}".format(r['wall']), "{:.0f} {}".format(r['rate'], phases[name]), "{:.1f}MB".format(r['rss_kb'] / 1024), change ])
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print ("Baseline saved to " + args.baseline)
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Generate a synthetic /proc tree for benchmarking connection_stats.py and fdstats.py
+(both accept --proc-root DIR to read it instead of /proc)
+
+DIR/net/{tcp,tcp6,udp,udp6}      socket tables in the kernel format
+DIR/<pid>/{comm,stat,cgroup,limits,fd/,task/}  processes with symlinked FDs (socket:[inode], pipe:[..], /dev/.., files)
+DIR/<pid>/ns/net, DIR/<pid>/net  one network namespace shared by all pids
+"""
+
+import os
+import sys
+import random
+import argparse
+
+### variables
+cfg = {} # configuration used in the script
+cfg['tcp_rows'] = 100000
+cfg['tcp6_rows'] = 10000
+cfg['udp_rows'] = 1000
+cfg['udp6_rows'] = 100
+cfg['pids'] = 1000
+cfg['fds'] = 50000 # total FDs over all pids
+cfg['tasks'] = 0 # extra threads (sharing the FD table) for each of the 10 biggest pids
+cfg['seed'] = 1
+
+# connection states with weights, roughly what a busy web front-end looks like
+tcp_states = [ (0x01, 60), (0x06, 33), (0x08, 2), (0x05, 2), (0x0A, 1), (0x02, 1), (0x03, 1) ]
+udp_states = [ (0x07, 90), (0x01, 10) ]
+
+# FD types with weights and a link target generator
+fd_kinds = [ ('socket', 45), ('anon_inode', 15), ('pipe', 15), ('file', 15), ('dev', 7), ('proc', 2), ('sys', 1) ]
+comms = [ 'java', 'nginx', 'python3', 'mongod', 'postgres', 'sshd', 'rsyslogd', 'systemd', 'containerd', 'bash' ]
+anon_inodes = [ '[eventpoll]', '[eventfd]', '[timerfd]', '[signalfd]', 'inotify', '[pidfd]' ]
+files = [ '/etc/passwd', '/etc/hosts', '/var/log/app.log', '/var/log/app.log (deleted)', '/usr/lib/libssl.so.3', '/srv/data/db.wt' ]
+devs = [ '/dev/null', '/dev/urandom', '/dev/pts/0', '/dev/shm/seg' ]
+### end variables
+
+### functions
+
+def parse_args ():
+    parser = argparse.ArgumentParser (
+        description = "Synthetic /proc tree generator for benchmarks",
+        usage = "%(prog)s DIR [--tcp_rows N] [--pids N] [--fds N]"
+    )
+    parser.add_argument ("dir", help="Where to create the tree (must not exist or be empty)")
+    for k in ('tcp_rows', 'tcp6_rows', 'udp_rows', 'udp6_rows', 'pids', 'fds', 'tasks', 'seed'):
+        parser.add_argument ("--" + k, type=int, help="default " + str(cfg[k]), default=cfg[k])
+    args = parser.parse_args()
+    for k in cfg:
+        cfg[k] = getattr(args, k)
+    cfg['dir'] = args.dir
+
+def weighted (choices):
+    """ pick from [(value, weight)] """
+    return random.choices([c[0] for c in choices], [c[1] for c in choices])[0]
+
+def hex_ipv4 (addr):
+    """ IPv4 address (integer) as /proc prints it: native (little endian) 32-bit word """
+    return "{:08X}".format(int.from_bytes(addr.to_bytes(4, "big"), "little"))
+
+def hex_ipv6 (addr):
+    """ IPv6 address (integer) as /proc prints it: four native (little endian) 32-bit words """
+    raw = addr.to_bytes(16, "big")
+    return "".join("{:08X}".format(int.from_bytes(raw[i:i+4], "little")) for i in range(0, 16, 4))
+
+def write_net (path, rows, v6, states, socket_inodes):
+    """ /proc/net/{tcp,udp}[6] table; non TIME_WAIT sockets get inodes from socket_inodes (owned by some pid) """
+    local = 0x0A000001 if not v6 else 0x20010DB8000000000000000000000001
+    # remote addresses come from a few pools, some hosts are much busier than others
+    pools = [ 0x0A140000, 0x0A150000, 0xC0A80000, 0xAC100000 ]
+    header = "  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n" if v6 else \
+             "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+    with open(path, "w") as f:
+        f.write(header)
+        for i in range(rows):
+            st = weighted(states)
+            if st == 0x0A:
+                l_port, r_ip, r_port = random.choice([80, 443, 22, 5432]), 0, 0
+            else:
+                l_port = random.choice([80] * 8 + [443] * 3 + [random.randrange(32768, 61000)])
+                r_ip = random.choice(pools) + int(random.paretovariate(1.2)) % 65536
+                r_port = random.randrange(1024, 65536)
+            if v6:
+                r_ip = (0xFFFF << 32) | r_ip if r_ip else 0
+                addr = hex_ipv6(local) + ":{:04X} ".format(l_port) + hex_ipv6(r_ip) + ":{:04X}".format(r_port)
+            else:
+                addr = hex_ipv4(local) + ":{:04X} ".format(l_port) + hex_ipv4(r_ip) + ":{:04X}".format(r_port)
+            inode = 0 if st == 0x06 or not socket_inodes else socket_inodes[i % len(socket_inodes)]
+            f.write("{:4d}: {} {:02X} 00000000:00000000 00:00000000 00000000  1000        0 {} 1 0000000000000000 20 4 30 10 -1\n".format(i, addr, st, inode))
+
+def write_stat (path, pid, ppid, comm, threads):
+    """ comm and stat files of a process or task """
+    with open(os.path.join(path, "comm"), "w") as f:
+        f.write(comm + "\n")
+    with open(os.path.join(path, "stat"), "w") as f:
+        f.write("{} ({}) S {} {} {} 0 -1 4194560 100 0 0 0 10 5 0 0 20 0 {} 0 {} 10000000 500 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 17 0 0 0 0 0 0\n".format(pid, comm, ppid, pid, pid, threads, 1000 + pid))
+
+def write_pid (root, pid, ppid, comm, n_fds, inode_seq, tasks=0):
+    """ /proc/<pid> with comm, stat, fd/ symlinks and task/<pid> plus extra tasks, all sharing the FD table """
+    path = os.path.join(root, str(pid))
+    os.makedirs(os.path.join(path, "fd"))
+    os.makedirs(os.path.join(path, "task", str(pid)))
+    os.makedirs(os.path.join(path, "ns"))
+    write_stat(path, pid, ppid, comm, tasks + 1)
+    with open(os.path.join(path, "cgroup"), "w") as f:
+        f.write("0::/system.slice/{}.service\n".format(comm))
+    with open(os.path.join(path, "limits"), "w") as f:
+        f.write("{:<26}{:<21}{:<21}{:<10}\n".format("Limit", "Soft Limit", "Hard Limit", "Units"))
+        f.write("{:<26}{:<21}{:<21}{:<10}\n".format("Max open files", max(1024, n_fds * 2), 524288, "files"))
+    write_stat(os.path.join(path, "task", str(pid)), pid, ppid, comm, tasks + 1)
+    os.symlink("../../fd", os.path.join(path, "task", str(pid), "fd"))
+    for t in range(tasks):
+        tid = pid * 1000 + t + 1
+        os.makedirs(os.path.join(path, "task", str(tid)))
+        write_stat(os.path.join(path, "task", str(tid)), tid, ppid, "{}-worker-{}".format(comm, t % 8), tasks + 1)
+        os.symlink("../../fd", os.path.join(path, "task", str(tid), "fd"))
+    os.symlink("net:[4026531840]", os.path.join(path, "ns", "net"))
+    os.symlink("../net", os.path.join(path, "net"))
+
+    sockets = []
+    fd_dir = os.path.join(path, "fd")
+    for fd in range(n_fds):
+        kind = weighted(fd_kinds)
+        if kind == 'socket':
+            inode = next(inode_seq)
+            sockets.append(inode)
+            target = "socket:[{}]".format(inode)
+        elif kind == 'pipe':
+            target = "pipe:[{}]".format(next(inode_seq))
+        elif kind == 'anon_inode':
+            target = "anon_inode:" + random.choice(anon_inodes)
+        elif kind == 'file':
+            target = random.choice(files)
+        elif kind == 'dev':
+            target = random.choice(devs)
+        elif kind == 'proc':
+            target = "/proc/{}/stat".format(pid)
+        else:
+            target = "/sys/fs/cgroup/memory.pressure"
+        os.symlink(target, os.path.join(fd_dir, str(fd)))
+    return sockets
+
+def fd_counts (pids, fds):
+    """ FDs per pid: a heavy tail, a few processes (the JVMs) hold most descriptors """
+    weights = [ random.paretovariate(0.8) for _ in range(pids) ]
+    total = sum(weights)
+    counts = [ max(1, int(fds * w / total)) for w in weights ]
+    return counts
+
+def generate (root):
+    os.makedirs(os.path.join(root, "net"), exist_ok=True)
+    inode_seq = iter(range(100000, 1 << 40))
+
+    socket_inodes = []
+    counts = fd_counts(cfg['pids'], cfg['fds'])
+    biggest = sorted(counts, reverse=True)[:10]
+    for i, n_fds in enumerate(counts):
+        pid = 100 + i * 3
+        ppid = 1 if i < 10 else 100 + random.randrange(0, i) * 3
+        tasks = cfg['tasks'] if n_fds in biggest else 0
+        socket_inodes.extend(write_pid(root, pid, ppid, random.choice(comms), n_fds, inode_seq, tasks))
+    random.shuffle(socket_inodes)
+
+    write_net(os.path.join(root, "net", "tcp"), cfg['tcp_rows'], False, tcp_states, socket_inodes)
+    write_net(os.path.join(root, "net", "tcp6"), cfg['tcp6_rows'], True, tcp_states, socket_inodes)
+    write_net(os.path.join(root, "net", "udp"), cfg['udp_rows'], False, udp_states, socket_inodes)
+    write_net(os.path.join(root, "net", "udp6"), cfg['udp6_rows'], True, udp_states, socket_inodes)
+
+### end functions
+
+if __name__ == "__main__":
+    parse_args()
+    if os.path.isdir(cfg['dir']) and os.listdir(cfg['dir']):
+        print (cfg['dir'] + " is not empty")
+        sys.exit(2)
+    random.seed(cfg['seed'])
+    generate(cfg['dir'])
+    print ("Generated {}: {} tcp, {} tcp6, {} udp, {} udp6 rows; {} pids, ~{} FDs".format(cfg['dir'], cfg['tcp_rows'], cfg['tcp6_rows'], cfg['udp_rows'], cfg['udp6_rows'], cfg['pids'], cfg['fds']))
@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import heapq
+import http.server
+import operator
+import os
 import sys
+import threading
+import time
 import struct
 import socket
-import codecs
 
 ### variables
 # the dictionary to store data from /proc/net/
@@ -19,6 +26,46 @@ default_proto = 'tcp'
 # variable for limiting (or not) the connection consumers in the output
 conn_output_limit = 10 # would be the default limit
 
+# where to get the data from: "proc" parses /proc/net/* text, "netlink" dumps sockets via NETLINK_SOCK_DIAG
+backend = 'proc'
+supported_backends = [ "proc", "netlink" ]
+
+# optional filters; with the netlink backend they are applied by the kernel
+state_filter = [] # list of hex states as in conn_states keys, e.g. ['01', '06']; empty means all
+port_filter = None # local or remote port (integer); None means all
+
+# where procfs is mounted; a different root allows running against a synthetic tree (see benchmarks/)
+proc_root = "/proc"
+
+# how much of /proc/net/* to read at once (characters); keeps memory flat on hosts with millions of sockets
+read_chunk_size = 1 << 20
+
+# remote IP rollups (--group-by): prefix length and the matching integer mask per IP version; None means no grouping
+group_prefix = { 4 : None, 6 : None }
+group_masks = { 4 : None, 6 : None }
+
+# sampling interval in seconds for the watch mode; None means a single report
+watch_interval = None
+
+# per process attribution (like ss -p): socket inode -> pid index built from /proc/*/fd once per run
+show_processes = False
+inode_index = None # socket inode (string) -> pid (string)
+proc_comm = {} # pid -> command name, for pids holding sockets
+net_owners = {} # proto -> "states"/"local_port" -> key -> Counter of pids
+index_workers = 32 # how many threads walk /proc/*/fd concurrently
+owners_output_limit = 3 # how many owning processes to show next to a state or local port
+
+# network namespaces (containers): every namespace is read through /proc/<pid>/net/ of one of its pids
+scan_all_netns = False
+ns_stats = {} # namespace (e.g. net:[4026531840]) -> { pid, comm, pids (count), stats (proto -> net_stats like dict) }
+netns_workers = os.cpu_count() or 1 # parser processes, namespaces are parsed in parallel
+
+# Prometheus exporter mode: snapshots are refreshed in the background, scrapes are served from the cache
+exporter_address = None # (host, port) to listen on; None means no exporter
+exporter_refresh = 15 # seconds between snapshots
+exporter_snapshot = b"" # last rendered metrics, replaced as a whole by the refresh thread
+metrics_prefix = "connection_stats_"
+
 # connections states
 conn_states = {
     '01' : 'ESTABLISHED',
@@ -34,13 +81,42 @@ conn_states = {
     '0B' : 'TCP_CLOSING',
     '0C' : 'TCP_NEW_SYN_RECV'
 }
+
+# positions of the fixed width hex columns in /proc/net/* rows (IPv4 and IPv6) once the "sl:" prefix is cut off, e.g.
+# 0100007F:BC8F 00000000:0000 0A ...
+proc_columns = {
+    4 : { 'local_port' : (9, 13), 'remote_ip' : (14, 22), 'remote_port' : (23, 27), 'states' : (28, 30) },
+    6 : { 'local_port' : (33, 37), 'remote_ip' : (38, 70), 'remote_port' : (71, 75), 'states' : (76, 78) }
+}
+
+# protocol name (as in /proc/net) -> (address family, IP protocol) for sock_diag requests
+diag_protos = {
+    'tcp'  : (socket.AF_INET, socket.IPPROTO_TCP),
+    'tcp6' : (socket.AF_INET6, socket.IPPROTO_TCP),
+    'udp'  : (socket.AF_INET, socket.IPPROTO_UDP),
+    'udp6' : (socket.AF_INET6, socket.IPPROTO_UDP)
+}
+
+# netlink / sock_diag constants, see linux/netlink.h, linux/sock_diag.h and linux/inet_diag.h
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+INET_DIAG_REQ_BYTECODE = 1
+INET_DIAG_BC_JMP = 1
+INET_DIAG_BC_S_GE = 2
+INET_DIAG_BC_S_LE = 3
+INET_DIAG_BC_D_GE = 4
+INET_DIAG_BC_D_LE = 5
 ### end variables
 
 ### functions
 
 def parse_args ():
     """ Argument parser"""
-    global protos, default_proto, supported_protos, conn_output_limit
+    global protos, default_proto, supported_protos, conn_output_limit, backend, state_filter, port_filter, watch_interval, show_processes, scan_all_netns, group_prefix, group_masks, exporter_address, exporter_refresh, proc_root
 
     parser = argparse.ArgumentParser (
         description = "Script to analyze connections and report usage",
@@ -48,6 +124,16 @@ def parse_args ():
     )
     parser.add_argument ("--ver", help="What to report: version of protocol tcp|tcp4|tcp6|udp|udp4|udp6 or all together)", default=default_proto)
     parser.add_argument ("--limit", help="How many top consumers to report; number or 'all')", default=conn_output_limit)
+    parser.add_argument ("--backend", help="Where to read sockets from: proc (parse /proc/net/*) or netlink (sock_diag dump, falls back to proc)", default=backend)
+    parser.add_argument ("--proc-root", help="Read procfs from this directory instead of /proc (e.g. a synthetic tree from benchmarks/gen_proc_fixture.py)", default=proc_root)
+    parser.add_argument ("--state", help="Only count sockets in these states, comma separated (e.g. ESTABLISHED,TIME_WAIT)")
+    parser.add_argument ("--port", type=int, help="Only count sockets with this local or remote port")
+    parser.add_argument ("--group-by", metavar="/PREFIX[,/PREFIX6]", help="Roll remote IPs up to prefixes, e.g. /24 or /24,/64 (a single prefix > 32 applies to IPv6 only)")
+    parser.add_argument ("--processes", help="Attribute sockets to processes (pid/command), like ss -p", action="store_true", default=False)
+    parser.add_argument ("--netns", help="all: report every network namespace (containers) and host-wide totals")
+    parser.add_argument ("--exporter", metavar="[ADDR:]PORT", help="Run as a Prometheus exporter serving /metrics on ADDR:PORT (all addresses if ADDR is omitted)")
+    parser.add_argument ("--refresh", type=float, metavar="SECONDS", help="How often the exporter takes a new snapshot (default " + str(exporter_refresh) + ")", default=exporter_refresh)
+    parser.add_argument ("--watch", type=float, metavar="INTERVAL", help="Keep running and report changes and rates every INTERVAL seconds")
     args = parser.parse_args()
 
     # protocol versions
@@ -71,36 +157,125 @@ def parse_args ():
         else:
             conn_output_limit = int(args.limit)
 
-def hex_to_ipv4(addr):
-    """ Convert /proc IPv4 hex address into standard IPv4 notation. """
-    # Instead of codecs.decode(), we can just convert a 4 byte hex string to an integer directly using python radix conversion.
-    # Basically, int(addr, 16) EQUALS:
-    # aOrig = addr
-    # addr = codecs.decode(addr, "hex")
-    # addr = struct.unpack(">L", addr)
-    # assert(addr == (int(aOrig, 16),))
-    addr = int(addr, 16)
-
-    # system native byte order, 4-byte integer
-    addr = struct.pack("=L", addr)
-    addr = socket.inet_ntop(socket.AF_INET, addr)
+    if args.backend not in supported_backends:
+        print (args.backend + " is not supported. Supported backends: " + " ".join(supported_backends))
+        exit (2)
+    backend = args.backend
+
+    proc_root = args.proc_root.rstrip("/") or "/"
+    if proc_root != "/proc" and backend == "netlink":
+        # sock_diag always reports the live kernel state
+        print ("--proc-root is set, using the proc backend", file=sys.stderr)
+        backend = "proc"
+
+    if args.state is not None:
+        for name in args.state.split(","):
+            st = str_to_state(name)
+            if st is None:
+                print (name + " is not a known state. Known states: " + " ".join(conn_states.values()))
+                exit (2)
+            state_filter.append(st)
+
+    if args.port is not None:
+        port_filter = args.port
+
+    if args.group_by is not None:
+        prefixes = []
+        for prefix in args.group_by.split(","):
+            try:
+                prefixes.append(int(prefix.strip().lstrip("/")))
+            except ValueError:
+                print (prefix + " is not a valid prefix, use e.g. /24 or /24,/64")
+                exit (2)
+        if len(prefixes) == 1 and prefixes[0] > 32:
+            prefixes = [ None, prefixes[0] ]
+        if len(prefixes) > 2 or (prefixes[0] is not None and not 0 <= prefixes[0] <= 32) or (len(prefixes) == 2 and not 0 <= prefixes[1] <= 128):
+            print (args.group_by + " is not valid, use /IPV4_PREFIX[,/IPV6_PREFIX] e.g. /24 or /24,/64")
+            exit (2)
+        group_prefix[4] = prefixes[0]
+        if len(prefixes) == 2:
+            group_prefix[6] = prefixes[1]
+        for v, bits in ((4, 32), (6, 128)):
+            if group_prefix[v] is not None:
+                group_masks[v] = ((1 << group_prefix[v]) - 1) << (bits - group_prefix[v])
+
+    if args.processes:
+        show_processes = True
+
+    if args.netns is not None:
+        if args.netns != "all":
+            print ("--netns supports only 'all'")
+            exit (2)
+        if show_processes:
+            print ("--processes is not supported with --netns all")
+            exit (2)
+        if backend == "netlink":
+            # sock_diag only sees the namespace of the socket it is sent on
+            print ("--netns all reads /proc/<pid>/net/*, the netlink backend is not used", file=sys.stderr)
+            backend = "proc"
+        scan_all_netns = True
+
+    if args.watch is not None:
+        if args.watch <= 0:
+            print ("--watch interval has to be positive")
+            exit (2)
+        watch_interval = args.watch
+
+    if args.exporter is not None:
+        if watch_interval is not None:
+            print ("--exporter and --watch can not be used together")
+            exit (2)
+        host, _, port = args.exporter.rpartition(":")
+        try:
+            exporter_address = (host.strip("[]"), int(port))
+        except ValueError:
+            print (args.exporter + " is not a valid exporter address, use PORT or ADDR:PORT")
+            exit (2)
+        if args.refresh <= 0:
+            print ("--refresh interval has to be positive")
+            exit (2)
+        exporter_refresh = args.refresh
+
+def hex_to_ip_int(addr):
+    """ Convert /proc hex address (IPv4 or IPv6) into an integer in network byte order, e.g. 127.0.0.1 -> 0x7F000001 """
+    # /proc prints the address as 32-bit words in system native byte order, 8 hex characters each
+    words = len(addr) // 8
+
+    # unpack the printed words, re-pack them in native byte order to get the address bytes back
+    addr = struct.unpack(">{}I".format(words), bytes.fromhex(addr))
+    addr = struct.pack("={}I".format(words), *addr)
+    return int.from_bytes(addr, "big")
+
+def ip_int_to_str(addr, v6, prefix=None):
+    """ Convert integer address into standard IPv4/IPv6 notation, with /prefix for --group-by rollups """
+    if v6:
+        addr = socket.inet_ntop(socket.AF_INET6, addr.to_bytes(16, "big"))
+    else:
+        addr = socket.inet_ntop(socket.AF_INET, addr.to_bytes(4, "big"))
+    if prefix is not None:
+        addr += "/" + str(prefix)
     return addr
 
-def hex_to_ipv6(addr):
-    """ Convert /proc IPv6 hex address into standard IPv6 notation. """
-    # turn ASCII hex address into binary
-    addr = codecs.decode(addr, "hex")
-
-    # unpack into 4 32-bit integers in big endian / network byte order
-    addr = struct.unpack('!LLLL', addr)
-
-    # re-pack as 4 32-bit integers in system native byte order
-    addr = struct.pack('@IIII', *addr)
-
-    # now we can use standard network APIs to format the address
-    addr = socket.inet_ntop(socket.AF_INET6, addr)
+def ip_key(addr, v6):
+    """ aggregation key of a remote address: the address itself or its --group-by prefix (integer masking) """
+    if v6:
+        # IPv4-mapped addresses (::ffff:a.b.c.d) are grouped with the IPv4 prefix
+        if addr >> 32 == 0xFFFF and group_masks[4] is not None:
+            return addr & (0xFFFFFFFFFFFFFFFFFFFFFFFF00000000 | group_masks[4])
+        if group_masks[6] is not None:
+            return addr & group_masks[6]
+    elif group_masks[4] is not None:
+        return addr & group_masks[4]
     return addr
 
+def ip_key_prefix(addr, v6):
+    """ prefix length the key was grouped by (see ip_key), None if not grouped """
+    if v6:
+        if addr >> 32 == 0xFFFF and group_prefix[4] is not None:
+            return group_prefix[4] + 96
+        return group_prefix[6]
+    return group_prefix[4]
+
 def hex_to_int_to_str (hex):
     """ Convert hex to integer (port numbers) and return string as output"""
     return str(int(hex, 16))
@@ -115,7 +290,96 @@ def state_to_str (st):
     else:
         return conn_states[st]
 
+def str_to_state (name):
+    """ State name (e.g. TIME_WAIT or TCP_TIME_WAIT, case insensitive) to the hex key used in conn_states
+    return None if the name is not known
+    """
+    name = name.strip().upper()
+    for st, st_name in conn_states.items():
+        if name == st_name or "TCP_" + name == st_name:
+            return st
+    return None
+
+def new_stats ():
+    """ empty counters for one protocol """
+    stats = {}
+    stats["remote_ip"] = collections.Counter()
+    stats["local_port"] = collections.Counter()
+    stats["remote_port"] = collections.Counter()
+    stats["states"] = collections.Counter()
+    return stats
+
+def init_stats (proto):
+    """ initialize dictionaries for the protocol if they don't exist """
+    if net_stats.get(proto) is None:
+        net_stats[proto] = new_stats()
+        if inode_index is not None:
+            net_stats[proto]["process"] = collections.Counter()
+            net_owners[proto] = {}
+            net_owners[proto]["states"] = collections.defaultdict(collections.Counter)
+            net_owners[proto]["local_port"] = collections.defaultdict(collections.Counter)
+
+def scan_pid_sockets (pid):
+    """ socket inodes open in the process; returns (pid, comm, list of inodes) """
+    inodes = []
+    try:
+        dfd = os.open(proc_root + "/" + pid + "/fd", os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        # pid is gone or not accessible
+        return pid, None, inodes
+    try:
+        for fd in os.listdir(dfd):
+            try:
+                ll = os.readlink(fd, dir_fd=dfd)
+            except OSError:
+                # the FD has been closed by the time we got here
+                continue
+            if ll.startswith("socket:["):
+                inodes.append(ll[8:-1])
+    except OSError:
+        pass
+    finally:
+        os.close(dfd)
+
+    comm = get_comm(pid) if inodes else "unknown"
+    return pid, comm, inodes
+
+def build_inode_index ():
+    """ socket inode -> pid index from all /proc/<pid>/fd in one parallel pass
+    workers only return their results, the index is filled in this thread; a socket shared by several processes
+    (e.g. inherited by forked workers) is attributed to the first pid in /proc order
+    """
+    global inode_index, proc_comm
+
+    index = {}
+    comms = {}
+    pids = [p for p in os.listdir(proc_root) if p.isdigit()]
+    with concurrent.futures.ThreadPoolExecutor ( max_workers = index_workers ) as executor:
+        for pid, comm, inodes in executor.map(scan_pid_sockets, pids):
+            if not inodes:
+                continue
+            comms[pid] = comm
+            for inode in inodes:
+                index.setdefault(inode, pid)
+
+    inode_index = index
+    proc_comm = comms
+
 def get_stats ( proto ):
+    """ collect stats for the protocol with the selected backend
+    netlink falls back to parsing /proc if sock_diag is not available (old kernel, missing udp_diag module, etc)
+    """
+    if backend == "netlink":
+        try:
+            get_stats_netlink (proto)
+            return
+        except OSError as err:
+            print ("netlink sock_diag not available for {} ({}), falling back to /proc/net/{}".format(proto, err, proto), file=sys.stderr)
+            # drop what might have been partially collected
+            net_stats.pop(proto, None)
+    get_stats_proc (proto)
+
+def get_stats_proc ( proto, stats=None, net_dir=None ):
     """
     get data from /proc filesystem the format with 4* Linux kernels is
     https://www.kernel.org/doc/html/latest//networking/proc_net_tcp.html
@@ -136,46 +400,260 @@ def get_stats ( proto ):
     tm->when        - number of jiffies until timer expires
     retrnsmt        - number of unrecovered RTO timeouts
     uid             -
+
+    the file is read in chunks and the fixed width hex columns are sliced (see proc_columns) instead of
+    splitting every row, so memory stays bounded by read_chunk_size and the number of unique keys
+    by default the counters go to net_stats; a namespace scan passes its own stats and /proc/<pid>/net/
     """
     global net_stats, protos
 
-# initialize dictionaries if don't exist
-    if net_stats.get(proto) is None:
-        net_stats[proto] = {}
-        net_stats[proto]["remote_ip"] = {}
-        net_stats[proto]["local_port"] = {}
-        net_stats[proto]["remote_port"] = {}
-        net_stats[proto]["states"] = {}
-
-    with open("/proc/net/" + proto, "r") as stats:
-        stats = stats.read().splitlines()
-        stats = stats[1:] # drop header row
-
-        for conn in stats:
-            conn = conn.split()
-
-            r_ip, r_port = conn[2].split(':') #(remote address is 3rd column (index #2)
-            if net_stats[proto]["remote_ip"].get(r_ip) is None:
-                net_stats[proto]["remote_ip"][r_ip] = 0
-            if net_stats[proto]["remote_port"].get(r_port) is None:
-                net_stats[proto]["remote_port"][r_port] = 0
-
-            l_ip, l_port = conn[1].split(':') #(local address is 2rd column (index #1)
-            if net_stats[proto]["local_port"].get(l_port) is None:
-                net_stats[proto]["local_port"][l_port] = 0
-
-            net_stats[proto]["remote_ip"][r_ip] += 1
-            net_stats[proto]["remote_port"][r_port] += 1
-            net_stats[proto]["local_port"][l_port] += 1
-
-            # connection states , 4th column (index #3)
-            st = conn[3]
-            if net_stats[proto]["states"].get(st) is None:
-                net_stats[proto]["states"][st] = 0
-            net_stats[proto]["states"][st] += 1
-
-def sort_dict_value (d):
-    """ sort dictionary by value"""
+    if stats is None:
+        init_stats (proto)
+        stats = net_stats[proto]
+    if net_dir is None:
+        net_dir = proc_root + "/net/"
+    cols = proc_columns[6 if proto.endswith("6") else 4]
+    port_hex = None if port_filter is None else "{:04X}".format(port_filter)
+
+    with open(net_dir + proto, "r") as f:
+        f.readline() # drop header row
+        tail = ""
+        while True:
+            chunk = f.read(read_chunk_size)
+            if not chunk:
+                break
+            rows = (tail + chunk).split("\n")
+            tail = rows.pop() # incomplete row, to be completed by the next chunk
+            add_proc_rows (stats, rows, cols, port_hex, net_owners.get(proto))
+        if tail.strip():
+            add_proc_rows (stats, [tail], cols, port_hex, net_owners.get(proto))
+
+def add_proc_rows (stats, rows, cols, port_hex, owners=None):
+    """ aggregate a chunk of /proc/net/* rows into the stats counters """
+    # cut the variable width "sl:" prefix, the rest of the columns have fixed positions
+    rows = [row[row.find(":") + 2:] for row in rows if row]
+
+    # filters, the netlink backend does this in the kernel
+    st0, st1 = cols["states"]
+    if state_filter:
+        rows = [row for row in rows if row[st0:st1] in state_filter]
+    if port_hex is not None:
+        lp0, lp1 = cols["local_port"]
+        rp0, rp1 = cols["remote_port"]
+        rows = [row for row in rows if row[lp0:lp1] == port_hex or row[rp0:rp1] == port_hex]
+
+    for k, (c0, c1) in cols.items():
+        if k == "remote_ip":
+            # count the hex strings of the chunk, then convert only the unique ones to integer keys
+            v6 = c1 - c0 == 32
+            remote_ip = stats[k]
+            for addr, cnt in collections.Counter([row[c0:c1] for row in rows]).items():
+                remote_ip[ip_key(hex_to_ip_int(addr), v6)] += cnt
+        else:
+            stats[k].update([row[c0:c1] for row in rows])
+
+    if owners is not None:
+        # inode is the 6th field after the state (tx:rx, tr:when, retrnsmt, uid, timeout are variable width)
+        lp0, lp1 = cols["local_port"]
+        pids = []
+        for row in rows:
+            tail = row[st1:].split()
+            pid = inode_index.get(tail[5], "0") if len(tail) > 5 else "0"
+            pids.append(pid)
+            owners["states"][row[st0:st1]][pid] += 1
+            owners["local_port"][row[lp0:lp1]][pid] += 1
+        stats["process"].update(pids)
+
+def diag_port_bytecode (port):
+    """ inet_diag bytecode for "sport == port || dport == port"
+    every condition is a pair of ops (code, yes, no) + (0, 0, port); "yes" continues with the next op,
+    "no" jumps relative to the op, and jumping 4 bytes past the end rejects the socket; the JMP op in the middle
+    accepts the socket when the sport condition matched (same layout as ss(8) builds for "a or b")
+    """
+    op = struct.Struct("=BBH")
+    # sport >= port && sport <= port; failing any jumps over the JMP to the dport part (offset 20)
+    bc = op.pack(INET_DIAG_BC_S_GE, 8, 20) + op.pack(0, 0, port)
+    bc += op.pack(INET_DIAG_BC_S_LE, 8, 12) + op.pack(0, 0, port)
+    # matched: JMP past the end (yes=4 is only used by the kernel verifier to walk the program)
+    bc += op.pack(INET_DIAG_BC_JMP, 4, 20)
+    # dport >= port && dport <= port; failing rejects
+    bc += op.pack(INET_DIAG_BC_D_GE, 8, 20) + op.pack(0, 0, port)
+    bc += op.pack(INET_DIAG_BC_D_LE, 8, 12) + op.pack(0, 0, port)
+    return bc
+
+def diag_request (proto, seq):
+    """ build SOCK_DIAG_BY_FAMILY dump request (nlmsghdr + inet_diag_req_v2 [+ bytecode attribute]) """
+    family, protocol = diag_protos[proto]
+
+    # states bitmask (1 << state), all states if no filter requested
+    if state_filter:
+        states = 0
+        for st in state_filter:
+            states |= 1 << int(st, 16)
+    else:
+        states = 0xFFFFFFFF
+
+    # inet_diag_req_v2: family, protocol, ext, pad, states, inet_diag_sockid (48 bytes, zeros = any)
+    req = struct.pack("=BBBBI", family, protocol, 0, 0, states) + bytes(48)
+    if port_filter is not None:
+        bc = diag_port_bytecode(port_filter)
+        req += struct.pack("=HH", 4 + len(bc), INET_DIAG_REQ_BYTECODE) + bc
+
+    return struct.pack("=IHHII", 16 + len(req), SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + req
+
+def get_stats_netlink ( proto ):
+    """
+    get data with a NETLINK_SOCK_DIAG dump; state and port filtering is done in the kernel
+    every reply carries inet_diag_msg:
+    (0)family (1)state (2)timer (3)retrans, inet_diag_sockid (sport, dport, src[16], dst[16], if, cookie), expires, rqueue, wqueue, uid, inode
+    ports and states are formatted exactly as /proc/net/* prints them and remote addresses are integers (see ip_key)
+    so output_stats() works for both backends
+    """
+    global net_stats
+
+    is_v6 = diag_protos[proto][0] == socket.AF_INET6
+    nlh = struct.Struct("=IHHII")
+    msg = struct.Struct("=BBBB2s2s16s16sI8sIIIII")
+
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_SOCK_DIAG) as sock:
+        sock.sendall(diag_request(proto, 1))
+        init_stats (proto)
+        stats = net_stats[proto]
+
+        done = False
+        while not done:
+            data = sock.recv(65536)
+            if not data:
+                break
+            offset = 0
+            while offset + nlh.size <= len(data):
+                msg_len, msg_type, _, _, _ = nlh.unpack_from(data, offset)
+                if msg_type == NLMSG_DONE:
+                    done = True
+                    break
+                if msg_type == NLMSG_ERROR:
+                    err = -struct.unpack_from("=i", data, offset + nlh.size)[0]
+                    raise OSError(err, os.strerror(err))
+
+                _, st, _, _, sport, dport, _, dst, _, _, _, _, _, _, inode = msg.unpack_from(data, offset + nlh.size)
+                # /proc prints the raw (network order) address words as native integers
+                if is_v6:
+                    r_ip = ip_key(int.from_bytes(dst, "big"), True)
+                else:
+                    r_ip = ip_key(int.from_bytes(dst[:4], "big"), False)
+                l_port = sport.hex().upper()
+                r_port = dport.hex().upper()
+                st = "{:02X}".format(st)
+
+                stats["remote_ip"][r_ip] += 1
+                stats["remote_port"][r_port] += 1
+                stats["local_port"][l_port] += 1
+                stats["states"][st] += 1
+
+                if inode_index is not None:
+                    pid = inode_index.get(str(inode), "0")
+                    stats["process"][pid] += 1
+                    net_owners[proto]["states"][st][pid] += 1
+                    net_owners[proto]["local_port"][l_port][pid] += 1
+
+                # messages are 4 bytes aligned
+                offset += (msg_len + 3) & ~3
+
+def collect_stats ():
+    """ one sample of all requested protocols; the inode -> pid index (if requested) is built once and shared """
+    if scan_all_netns:
+        get_stats_all_netns ()
+        return
+    if show_processes:
+        build_inode_index ()
+    for v in protos:
+        get_stats (v)
+
+def get_netns ():
+    """ distinct network namespaces: namespace -> (lowest pid in it, number of pids) """
+    netns = {}
+    for pid in sorted((p for p in os.listdir(proc_root) if p.isdigit()), key=int):
+        try:
+            ns = os.readlink(proc_root + "/" + pid + "/ns/net")
+        except OSError:
+            # pid is gone, or a kernel thread we are not allowed to look at
+            continue
+        if ns in netns:
+            netns[ns][1] += 1
+        else:
+            netns[ns] = [pid, 1]
+    return netns
+
+def set_filters (states, port, prefix, masks, root):
+    """ process pool initializer: parse_args() globals are not inherited with spawn/forkserver """
+    global state_filter, port_filter, group_prefix, group_masks, proc_root
+    proc_root = root
+    state_filter = states
+    port_filter = port
+    group_prefix = prefix
+    group_masks = masks
+
+def scan_netns (pid, protocols):
+    """ stats of all protocols in the namespace of the pid; runs in a pool process """
+    result = {}
+    for proto in protocols:
+        stats = new_stats()
+        try:
+            get_stats_proc (proto, stats, proc_root + "/" + pid + "/net/")
+        except OSError:
+            # the pid (and maybe the namespace) is gone
+            pass
+        result[proto] = stats
+    return result
+
+def get_stats_all_netns ():
+    """ parse every network namespace once (one pid per namespace) in a process pool
+    per namespace results go to ns_stats, host-wide sums to net_stats
+    """
+    global ns_stats
+
+    netns = get_netns()
+    ns_stats = {}
+    for proto in protos:
+        init_stats (proto)
+
+    with concurrent.futures.ProcessPoolExecutor ( max_workers = netns_workers, initializer = set_filters, initargs = (state_filter, port_filter, group_prefix, group_masks, proc_root) ) as executor:
+        pids = [netns[ns][0] for ns in netns]
+        for ns, result in zip(netns, executor.map(scan_netns, pids, [protos] * len(pids), chunksize = 4)):
+            pid, n_pids = netns[ns]
+            ns_stats[ns] = { "pid" : pid, "comm" : get_comm(pid), "pids" : n_pids, "stats" : result }
+            for proto in result:
+                for k2 in result[proto]:
+                    net_stats[proto][k2].update(result[proto][k2])
+
+def get_comm (pid):
+    """ command name of the pid """
+    try:
+        with open(proc_root + "/" + pid + "/comm") as f:
+            return f.read().rstrip("\n")
+    except OSError:
+        return "unknown"
+
+def output_netns ():
+    """ per namespace summary: sockets per protocol and the most common states, busiest namespaces first """
+    totals = {}
+    for ns in ns_stats:
+        totals[ns] = sum(sum(st["states"].values()) for st in ns_stats[ns]["stats"].values())
+
+    print ("------------------ namespaces: total {}; sockets {} (namespace:count)------------------".format(len(ns_stats), sum(totals.values())))
+    for ns, cnt in sort_dict_value(totals, conn_output_limit):
+        info = ns_stats[ns]
+        per_proto = " ".join("{} {}".format(proto, sum(info["stats"][proto]["states"].values())) for proto in sorted(info["stats"]))
+        states = collections.Counter()
+        for proto in info["stats"]:
+            states.update(info["stats"][proto]["states"])
+        top_states = " ".join("{}:{}".format(state_to_str(st), n) for st, n in sort_dict_value(states, owners_output_limit))
+        print (" {} {}({}) pids {} : {} ({}) {}".format(ns, info["comm"], info["pid"], info["pids"], cnt, per_proto, top_states))
+
+def sort_dict_value (d, limit=0):
+    """ sort dictionary by value; with a limit only the top entries are selected (heap, no full sort) """
+    if limit > 0:
+        return heapq.nlargest(limit, d.items(), key=operator.itemgetter(1))
     my_sorted = sorted(d.items(), key=lambda item: item[1], reverse=True)
     return my_sorted
 
@@ -191,29 +669,218 @@ def output_stats():
             print ("------------------ {} : {}: total {}; unique {} (key:count)------------------".format(k,k2,str(total),str(uniq)))
 
             limit = 0
-            for k3, cnt in sort_dict_value(net_stats[k][k2]): # key # 3 which is value (say IP address) and cnt is the associated counter
+            for k3, cnt in sort_dict_value(net_stats[k][k2], conn_output_limit): # key # 3 which is value (say IP address) and cnt is the associated counter
                 if limit+1 > conn_output_limit and conn_output_limit != 0:
                     break;
 
-                if ( k2 == "local_port" or k2 == "remote_port" ):
-                    print (" {} : {}".format(hex_to_int_to_str(k3),str(cnt)))
-                elif k2 == "states":
-                    print (" {} : {}".format(state_to_str(k3),str(cnt)))
-
+                owners = net_owners.get(k, {}).get(k2, {}).get(k3)
+                if owners:
+                    print (" {} : {}  <- {}".format(key_to_str(k, k2, k3),str(cnt),owners_to_str(owners)))
                 else:
-                    if k == "tcp6":
-                        print (" {} : {}".format(hex_to_ipv6(k3),str(cnt)))
-                    else:
-                        print (" {} : {}".format(hex_to_ipv4(k3),str(cnt)))
+                    print (" {} : {}".format(key_to_str(k, k2, k3),str(cnt)))
                 limit += 1
 
+def owners_to_str (owners):
+    """ top owning processes of a state / local port, e.g. "java(870):40 nginx(1):1" """
+    top = sort_dict_value(owners, owners_output_limit)
+    return " ".join("{}:{}".format(pid_to_str(pid), cnt) for pid, cnt in top)
+
+def pid_to_str (pid):
+    """ command(pid) for the process dimension """
+    if pid == "0":
+        return "(no process)"
+    return "{}({})".format(proc_comm.get(pid, "unknown"), pid)
+
+def key_to_str (proto, kind, key):
+    """ human readable form of a net_stats key (port, state, process or remote IP) """
+    if ( kind == "local_port" or kind == "remote_port" ):
+        return hex_to_int_to_str(key)
+    elif kind == "states":
+        return state_to_str(key)
+    elif kind == "process":
+        return pid_to_str(key)
+    else:
+        v6 = proto.endswith("6")
+        return ip_int_to_str(key, v6, ip_key_prefix(key, v6))
+
+def output_deltas (prev, elapsed):
+    """ watch mode output: per key change since the previous snapshot and rate per second
+    keys are ordered by the size of the change, keys that did not change are not shown
+    """
+    global net_stats, conn_output_limit
+
+    print ("================== {} : interval {:.2f}s ==================".format(time.strftime("%Y-%m-%d %H:%M:%S"), elapsed))
+    for k in sorted(net_stats):
+        for k2 in sorted(net_stats[k], reverse=True):
+            cur = net_stats[k][k2]
+            old = prev.get(k, {}).get(k2, {})
+
+            deltas = {}
+            for k3 in cur.keys() | old.keys():
+                d = cur.get(k3, 0) - old.get(k3, 0)
+                if d != 0:
+                    deltas[k3] = d
+
+            total = sum(cur.values())
+            total_delta = total - sum(old.values())
+            print ("------------------ {} : {}: total {} ({:+d}, {:+.1f}/s); changed {} (key:count (delta, rate))------------------".format(k, k2, total, total_delta, total_delta / elapsed, len(deltas)))
+
+            if conn_output_limit > 0:
+                top = heapq.nlargest(conn_output_limit, deltas.items(), key=lambda item: abs(item[1]))
+            else:
+                top = sorted(deltas.items(), key=lambda item: abs(item[1]), reverse=True)
+            for k3, d in top:
+                print (" {} : {} ({:+d}, {:+.1f}/s)".format(key_to_str(k, k2, k3), cur.get(k3, 0), d, d / elapsed))
+
+def watch (interval):
+    """ keep sampling every interval seconds and report what changed since the previous sample
+    the first sample is reported as absolute counts
+    """
+    global net_stats
+
+    prev = None
+    prev_time = None
+    while True:
+        start = time.monotonic()
+        net_stats.clear()
+        net_owners.clear()
+        collect_stats ()
+
+        if prev is None:
+            output_stats ()
+            if scan_all_netns:
+                output_netns ()
+        else:
+            output_deltas (prev, start - prev_time)
+        sys.stdout.flush()
+
+        # init_stats() creates new dictionaries on every sample, so keeping the references is enough
+        prev = dict(net_stats)
+        prev_time = start
+        time.sleep (max(0, start + interval - time.monotonic()))
+
+def prom_escape (value):
+    """ escape a Prometheus label value """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def render_metrics (duration):
+    """ current net_stats (and ns_stats) in Prometheus text exposition format
+    states are exported in full; ports, remote IPs and processes only for the top --limit entries to keep cardinality bounded
+    """
+    out = []
+    metrics = {
+        "states" : ("state_sockets", "Sockets by protocol and state", "state"),
+        "local_port" : ("local_port_sockets", "Sockets by local port (top --limit ports)", "port"),
+        "remote_port" : ("remote_port_sockets", "Sockets by remote port (top --limit ports)", "port"),
+        "remote_ip" : ("remote_ip_sockets", "Sockets by remote IP or --group-by prefix (top --limit)", "remote_ip"),
+        "process" : ("process_sockets", "Sockets by owning process (top --limit)", "process")
+    }
+    for k2 in sorted(metrics):
+        name, help, label = metrics[k2]
+        rows = []
+        for k in sorted(net_stats):
+            if k2 not in net_stats[k]:
+                continue
+            limit = 0 if k2 == "states" else conn_output_limit
+            for k3, cnt in sort_dict_value(net_stats[k][k2], limit):
+                rows.append('{}{}{{proto="{}",{}="{}"}} {}'.format(metrics_prefix, name, k, label, prom_escape(key_to_str(k, k2, k3)), cnt))
+        if rows:
+            out.append("# HELP {}{} {}".format(metrics_prefix, name, help))
+            out.append("# TYPE {}{} gauge".format(metrics_prefix, name))
+            out.extend(rows)
+
+    out.append("# HELP {}sockets Sockets by protocol".format(metrics_prefix))
+    out.append("# TYPE {}sockets gauge".format(metrics_prefix))
+    for k in sorted(net_stats):
+        out.append('{}sockets{{proto="{}"}} {}'.format(metrics_prefix, k, sum(net_stats[k]["states"].values())))
+
+    if scan_all_netns:
+        out.append("# HELP {}netns_sockets Sockets by network namespace and protocol".format(metrics_prefix))
+        out.append("# TYPE {}netns_sockets gauge".format(metrics_prefix))
+        for ns in sorted(ns_stats):
+            info = ns_stats[ns]
+            for proto in sorted(info["stats"]):
+                out.append('{}netns_sockets{{netns="{}",pid="{}",comm="{}",proto="{}"}} {}'.format(metrics_prefix, prom_escape(ns), info["pid"], prom_escape(info["comm"]), proto, sum(info["stats"][proto]["states"].values())))
+
+    out.append("# HELP {}snapshot_duration_seconds Time it took to collect the last snapshot".format(metrics_prefix))
+    out.append("# TYPE {}snapshot_duration_seconds gauge".format(metrics_prefix))
+    out.append("{}snapshot_duration_seconds {:.6f}".format(metrics_prefix, duration))
+    out.append("# HELP {}snapshot_timestamp_seconds When the last snapshot was collected".format(metrics_prefix))
+    out.append("# TYPE {}snapshot_timestamp_seconds gauge".format(metrics_prefix))
+    out.append("{}snapshot_timestamp_seconds {:.3f}".format(metrics_prefix, time.time()))
+    return ("\n".join(out) + "\n").encode("utf-8")
+
+def refresh_snapshot ():
+    """ collect a new sample and replace the cached metrics; only the refresh thread calls this """
+    global exporter_snapshot
+
+    start = time.monotonic()
+    net_stats.clear()
+    net_owners.clear()
+    collect_stats ()
+    # a single assignment, scrapes see either the old or the new snapshot
+    exporter_snapshot = render_metrics(time.monotonic() - start)
+
+def refresh_loop (interval):
+    """ background thread: refresh the snapshot every interval seconds; a failed refresh keeps the previous one """
+    next_refresh = time.monotonic() + interval
+    while True:
+        time.sleep (max(0, next_refresh - time.monotonic()))
+        next_refresh += interval
+        try:
+            refresh_snapshot ()
+        except Exception as err:
+            print ("snapshot refresh failed: {}".format(err), file=sys.stderr)
+
+class MetricsHandler (http.server.BaseHTTPRequestHandler):
+    """ serves the cached snapshot; scrapes never trigger a /proc/net parse """
+
+    def do_GET (self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = exporter_snapshot
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message (self, format, *args):
+        # no access log, scrapes are frequent
+        pass
+
+def run_exporter (address, interval):
+    """ take the first snapshot, then keep refreshing it in a background thread and serve it over HTTP """
+    refresh_snapshot ()
+    threading.Thread(target=refresh_loop, args=(interval,), daemon=True).start()
+
+    server = http.server.ThreadingHTTPServer(address, MetricsHandler)
+    server.daemon_threads = True
+    print ("Serving metrics on http://{}:{}/metrics".format(address[0] or "0.0.0.0", server.server_address[1]), file=sys.stderr)
+    server.serve_forever()
+
 ### end functions
 
 def main():
     parse_args()
-    for v in protos:
-        get_stats (v)
-
+    if exporter_address is not None:
+        try:
+            run_exporter (exporter_address, exporter_refresh)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if watch_interval is not None:
+        try:
+            watch (watch_interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    collect_stats ()
     output_stats ()
+    if scan_all_netns:
+        output_netns ()
 
 if __name__ == '__main__': main()
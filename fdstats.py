@@ -1,39 +1,78 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import sys
+import pwd
+import time
+import types
+import heapq
+import errno
+import random
+import operator
+import ctypes
 import argparse
+import platform
+import threading
+import itertools
+import collections
 import concurrent.futures
 
 """
 File Descriptor stats
 compare speed to
 lsof -n | awk '{ print $2 " " $1; }' | sort -rn | uniq -c | sort -rn | head -20
+
+can be embedded as well, the scan state lives in FDScanner and every scan returns an immutable FDSnapshot:
+    with fdstats.FDScanner(max_workers=32) as scanner:
+        snap = scanner.scan()
+        print (snap.fd_total, snap.totals['socket'], snap.pids['1'].stats, snap.timings)
 """
 
 # variables
-pid_list = [] # list only, to be used in concurrent execution
-pid_score = {} # pid -> count of all FDs, to be used for sorting top FD consumers
-pid_stats = {} # to keep all the counters for each FD type
-pid_extra = {} # to keep extra info, like command (comm), parent pid (ppid), etc
-pid_threads = {} # to keep thread specific stats if requested
-
-totals = { # grand totals for all types with counters
-    'socket' : 0,
-    'anon_inode' : 0,
-    'pipe' : 0,
-    'dev' : 0,
-    'sys' : 0,
-    'run' : 0,
-    'proc' : 0,
-    'file' : 0 ,
-    'unknown' : 0
-}
-cfg = {} # configuration used in the script
-cfg['max_workers'] = 300 # how many threads to use concurrently
+fd_types = ['socket', 'anon_inode', 'pipe', 'dev', 'sys', 'run', 'proc', 'file', 'unknown'] # grand totals are kept for all of these
+worker_executor = None # process pool workers (--procs): thread pool kept between shards, see init_worker
+
+cfg = {} # configuration used in the script ; FDScanner takes a copy, so several scanners may use different settings
+cfg['max_workers'] = 300 # how many threads to use concurrently (split between processes with --procs)
+cfg['min_workers'] = 8 # minimum threads per process with --procs
+cfg['procs'] = 1 # how many processes to shard the pids across
 cfg['max_pids'] = 10 # how many pids to show
 cfg['show_threads'] = False
 cfg['max_threads'] = 5
 cfg['include_self'] = False
+cfg['quick'] = False # two phase scan: count FDs of all pids, classify only the top max_pids
+cfg['sample'] = 0.05 # quick scan: fraction of the other pids classified to estimate the type totals (0: no type totals)
+cfg['scan_tasks'] = True # also scan /proc/<pid>/task/*/fd (the quick scan without --threads counts the process FD table only)
+cfg['fd_size'] = None # st_size of /proc/<pid>/fd is the number of FDs (Linux 6.2+): None unknown yet, True / False once checked
+cfg['fd_type_cache_max'] = 1000000 # max distinct paths kept in the FD type cache of a scan (see new_state)
+cfg['kcmp'] = None # kcmp(2) usable to detect shared FD tables: None unknown yet, True / False once tried
+cfg['top_files'] = 0 # how many of the most held open targets (files, pipes, sockets, anon inodes) to show ; 0: no report
+cfg['top_files_max'] = 0 # top files report: max targets kept in memory (heavy hitters only) ; 0: exact, every target is kept
+cfg['watch'] = None # sampling interval in seconds for the leak detection (watch) mode ; None means a single report
+cfg['history'] = 10 # watch mode: samples kept per pid, growth rates are computed over this window
+cfg['leak_samples'] = 5 # watch mode: samples of never decreasing FD counts before a pid is flagged as a likely leak
+cfg['pid_filter'] = None # only these pids (set of strings) ; /proc is not listed at all
+cfg['uid_filter'] = None # only pids owned by these uids (set of integers)
+cfg['comm_filter'] = None # only pids whose comm matches this (compiled) regex
+cfg['cgroup_filter'] = None # only pids in this cgroup or below it
+cfg['group_by'] = None # 'cgroup': roll up FD counts and types per cgroup instead of listing pids
+cfg['proc_root'] = '/proc' # where procfs is mounted; a different root allows running against a synthetic tree (see benchmarks/)
+
+# kcmp(2) syscall numbers ; KCMP_FILES compares the FD tables of two tasks
+kcmp_syscalls = {'x86_64' : 312, 'aarch64' : 272, 'i686' : 349, 'i386' : 349, 'armv7l' : 378, 'ppc64le' : 354, 's390x' : 343}
+KCMP_FILES = 2
+libc = ctypes.CDLL(None, use_errno=True)
+
+# results of a scan (FDScanner), read only: the dictionaries inside are mapping proxies
+# pids: pid -> PidStats ; totals: FD type -> count ; timings: phase -> seconds
+# top_files: TopFiles or None ; watch samples only (None otherwise): window, fd_delta, totals_delta, growth (pid -> Growth), rescanned
+FDSnapshot = collections.namedtuple('FDSnapshot', ['time', 'pids', 'totals', 'fd_total', 'estimated', 'top_files', 'timings',
+                                                   'window', 'fd_delta', 'totals_delta', 'growth', 'rescanned'])
+PidStats = collections.namedtuple('PidStats', ['score', 'stats', 'meta', 'threads']) # threads: thread comm -> FDs, None if not scanned
+TopFiles = collections.namedtuple('TopFiles', ['top', 'distinct', 'error']) # top: ((target, FDs, pids), ...) ; with error > 0 (bounded
+# mode) FDs and pids are lower bounds, both low by at most error, and distinct is the number of targets kept, not seen
+Growth = collections.namedtuple('Growth', ['rate', 'leak', 'limit', 'types']) # FDs per second, likely leak, RLIMIT_NOFILE, FD type -> growth
 # end variables
 
 ### functions
@@ -47,6 +86,19 @@ def parse_args ():
     parser.add_argument ("--threads", help="Include also threads in the output", action="store_true", default=False)
     parser.add_argument ("--include_self", help="Include also stats from this script", action="store_true", default=False)
     parser.add_argument ("--max_threads", type=int, help="Max num of threads per pid to show (requires --threads)", default=cfg['max_threads'])
+    parser.add_argument ("--proc-root", help="Read procfs from this directory instead of /proc (e.g. a synthetic tree from benchmarks/gen_proc_fixture.py)", default=cfg['proc_root'])
+    parser.add_argument ("--procs", type=int, help="Shard the scan across N processes (0: one per CPU)", default=cfg['procs'])
+    parser.add_argument ("--quick", help="Count FDs of all pids, classify only the top --max_pids (type totals are sampled)", action="store_true", default=False)
+    parser.add_argument ("--sample", type=float, help="With --quick: fraction of the other pids classified to estimate type totals (0: skip, 1: exact)", default=cfg['sample'])
+    parser.add_argument ("--pid", help="Only these pids (comma separated)")
+    parser.add_argument ("--uid", help="Only pids owned by these users (comma separated uids or names)")
+    parser.add_argument ("--comm", metavar="REGEX", help="Only pids whose command (comm) matches REGEX")
+    parser.add_argument ("--cgroup", metavar="PATH", help="Only pids in cgroup PATH or below it (as in /proc/<pid>/cgroup)")
+    parser.add_argument ("--group-by", choices=["cgroup"], help="Sum FD counts and types per cgroup (top --max_pids groups) instead of listing pids")
+    parser.add_argument ("--top-files", type=int, metavar="N", help="Also show the N targets (files, pipes, sockets, anon inodes) held open the most over all processes", default=cfg['top_files'])
+    parser.add_argument ("--top-files-max", type=int, metavar="ENTRIES", help="With --top-files: keep at most about 2*ENTRIES targets in memory, counts of the top ones are accurate (0: exact)", default=cfg['top_files_max'])
+    parser.add_argument ("--watch", type=float, metavar="INTERVAL", help="Keep sampling every INTERVAL seconds and rank pids by FD growth (leak detection)")
+    parser.add_argument ("--history", type=int, help="With --watch: samples kept per pid, growth is computed over this window", default=cfg['history'])
     args = parser.parse_args()
     if args.max_pids is not None:
         cfg['max_pids'] = args.max_pids
@@ -56,6 +108,57 @@ def parse_args ():
         cfg['show_threads'] = True
     if args.include_self:
         cfg['include_self'] = True
+    cfg['proc_root'] = args.proc_root.rstrip("/") or "/"
+    cfg['procs'] = args.procs if args.procs > 0 else (os.cpu_count() or 1)
+    if args.quick:
+        cfg['quick'] = True
+        cfg['sample'] = min(1, max(0, args.sample))
+        cfg['scan_tasks'] = cfg['show_threads']
+    if args.pid is not None:
+        cfg['pid_filter'] = set(p.strip() for p in args.pid.split(",") if p.strip())
+        if not all(p.isdigit() for p in cfg['pid_filter']):
+            print (args.pid + " is not a list of pids")
+            exit (2)
+    if args.uid is not None:
+        cfg['uid_filter'] = set()
+        for u in args.uid.split(","):
+            u = u.strip()
+            try:
+                cfg['uid_filter'].add(int(u) if u.isdigit() else pwd.getpwnam(u).pw_uid)
+            except KeyError:
+                print ("unknown user " + u)
+                exit (2)
+    if args.comm is not None:
+        try:
+            cfg['comm_filter'] = re.compile(args.comm)
+        except re.error as e:
+            print ("--comm {} is not a valid regex: {}".format(args.comm, e))
+            exit (2)
+    if args.cgroup is not None:
+        cfg['cgroup_filter'] = "/" + args.cgroup.strip("/")
+    if args.group_by is not None:
+        if args.watch is not None:
+            print ("--group-by can not be used with --watch")
+            exit (2)
+        cfg['group_by'] = args.group_by
+    if args.top_files > 0:
+        if args.quick or args.watch is not None:
+            print ("--top-files needs a full scan, it can not be used with --quick or --watch")
+            exit (2)
+        cfg['top_files'] = args.top_files
+        cfg['top_files_max'] = max(0, args.top_files_max) and max(args.top_files_max, args.top_files)
+    if args.watch is not None:
+        if args.watch <= 0 or args.history < 2:
+            print ("--watch interval has to be positive and --history at least 2")
+            exit (2)
+        if args.quick:
+            print ("--watch and --quick can not be used together")
+            exit (2)
+        cfg['watch'] = args.watch
+        cfg['history'] = args.history
+        cfg['leak_samples'] = min(cfg['leak_samples'], cfg['history'])
+        # FDs are counted per process FD table (see count_fds) ; tasks only matter for the thread listing
+        cfg['scan_tasks'] = cfg['show_threads']
 
 def print_row(arr):
     for i in range(len(arr)):
@@ -76,46 +179,115 @@ def sort_nested_dic(d, col='score', rev=True):
     # currently not used
     return sorted(d.items(), key=lambda x: x[1]['score'], reverse=rev)
 
-def get_pids(path = "/proc"):
+def get_pids(path = None, conf = cfg, cgroups = None):
     tmp_pid_list = []
     self_pid = str(os.getpid())
 
     # we'd like to determine if we are processing processes or tasks;
     # if this is a process, it will call itself recursively to process also tasks
-    if path == "/proc":
+    if path is None:
+        path = conf['proc_root']
         isTask = False
     else:
         isTask = True
 
     # all the integer directories in /proc are processes
-    try:
-        fobj = os.scandir(path)
-    except:
-        # pid or task is gone at this point
-        return
-    for item in fobj:
-        
-        if not cfg['include_self'] and item.name == self_pid:
+    names = None if isTask else pid_filter_list(conf)
+    if names is None:
+        try:
+            names = [item.name for item in os.scandir(path) if item.is_dir() and item.name.isdigit()]
+        except:
+            # pid or task is gone at this point
+            return
+    for name in names:
+
+        if not conf['include_self'] and name == self_pid:
+            continue
+
+        # the filters are applied before any FD of the pid is read
+        if not isTask and not pid_matches(name, conf, cgroups):
+            continue
+
+        try:
+            # verify if any file descriptors exist in the directory
+            if any(os.scandir(path+"/"+name+"/fd")):
+                tmp_pid_list.append(name)
+        except:
             continue
-            
-        if item.is_dir() and item.name.isdigit():
-            try:
-                # verify if any file descriptors exist in the directory
-                if any(os.scandir(path+"/"+item.name+"/fd")):
-                    tmp_pid_list.append(item.name)
-                    if not isTask:
-                        pid_score[item.name] = 0
-            except:
-                continue
     return tmp_pid_list
 
-def remove_pid(pid):
-    # currently not used
-    pid_list.remove(pid)
-    pid_score.pop(pid)
+def pid_filter_list (conf = cfg):
+    # --pid given: just these pids, /proc is not listed ; None otherwise
+    if conf['pid_filter'] is None:
+        return None
+    return sorted(conf['pid_filter'], key=int)
 
-def get_fd_type (s):
+def pid_matches (pid, conf = cfg, cgroups = None):
+    # --uid, --comm and --cgroup filters, the cheapest first ; cgroup paths read on the way are kept in cgroups
+    if conf['uid_filter'] is None and conf['comm_filter'] is None and conf['cgroup_filter'] is None:
+        return True
+    path = conf['proc_root'] + "/" + pid
+    try:
+        if conf['uid_filter'] is not None and os.stat(path).st_uid not in conf['uid_filter']:
+            return False
+        if conf['comm_filter'] is not None:
+            f = open(path + "/comm")
+            comm = f.read().rstrip("\n")
+            f.close()
+            if not conf['comm_filter'].search(comm):
+                return False
+    except:
+        # pid is gone
+        return False
+    if conf['cgroup_filter'] is not None:
+        cgroup = get_cgroup(pid, conf)
+        if cgroups is not None:
+            cgroups[pid] = cgroup
+        if cgroup is None:
+            return False
+        prefix = conf['cgroup_filter']
+        return prefix == "/" or cgroup == prefix or cgroup.startswith(prefix + "/")
+    return True
+
+def get_cgroup (pid, conf = cfg):
+    # cgroup path of the process from /proc/<pid>/cgroup: the unified (v2) one, or on v1 / hybrid hosts the first
+    # hierarchy that is not the root ; None if the pid is gone
+    try:
+        f = open(conf['proc_root'] + "/" + pid + "/cgroup")
+        data = f.read()
+        f.close()
+    except:
+        return None
+    unified = None
+    v1 = None
+    for line in data.splitlines():
+        hierarchy, _, cgroup = line.split(":", 2)
+        if hierarchy == "0":
+            unified = cgroup
+        elif v1 is None and cgroup != "/":
+            v1 = cgroup
+    if unified is not None and (unified != "/" or v1 is None):
+        return unified
+    return v1 or "/"
+
+def get_fd_type (s, cache = None, conf = cfg):
     # classify descriptors by type ; https://man7.org/linux/man-pages/man5/proc.5.html
+    # dispatch on the link target prefix ; with the cache of a scan paths are classified (and stat'ed) once per scan
+    if s[:1] != '/':
+        if s.startswith("socket:["): return "socket"
+        elif s.startswith("pipe:["): return "pipe"
+        elif s.startswith("anon_inode:"): return "anon_inode"
+    if cache is None:
+        return get_path_type(s)
+    fd_type = cache.get(s)
+    if fd_type is None:
+        fd_type = get_path_type(s)
+        if len(cache) < conf['fd_type_cache_max']:
+            cache[s] = fd_type
+    return fd_type
+
+def get_path_type (s):
+    # classify a link target by substrings, the file check costs a stat
     if "socket:" in s: return "socket"
     elif "anon_inode:" in s: return "anon_inode" # file descriptors produced by bpf(2), epoll_create(2), eventfd(2), inotify_init(2), perf_event_open(2), signalfd(2), timerfd_create(2), and userfaultfd(2)
     elif "/dev/" in s: return "dev"
@@ -130,49 +302,106 @@ def get_fd_type (s):
     else:
         return "unknown"
 
-def get_comm(pid, path = ""):
-    # get command name associated with the process/thread ; maximum TASK_COMM_LEN (16) characters
-    if len(path) > 0:
-        path = path + "/comm"
-    else:
-        path = "/proc/" + pid + "/comm"
+def get_meta(pid, path = "", conf = cfg):
+    # process (or task, if path is given) metadata from a single read of its stat file ; https://man7.org/linux/man-pages/man5/proc.5.html
+    # pid (comm) state ppid pgrp session tty_nr tpgid flags minflt cminflt majflt cmajflt utime stime cutime cstime priority nice num_threads itrealvalue starttime ...
+    if len(path) == 0:
+        path = conf['proc_root'] + "/" + pid
+    meta = {'comm' : 'unknown', 'ppid' : 'unknown', 'uid' : 'unknown', 'num_threads' : 0, 'starttime' : 0}
     try:
-        f = open(path)
-        data = f.read().replace("\n", "")
+        f = open(path + "/stat")
+        data = f.read()
         f.close()
-        return data
+        # comm is limited to TASK_COMM_LEN (16) characters but may contain spaces and parentheses
+        start = data.find('(')
+        end = data.rfind(')')
+        meta['comm'] = data[start+1:end]
+        fields = data[end+2:].split()
+        meta['ppid'] = fields[1]
+        meta['num_threads'] = int(fields[17])
+        meta['starttime'] = int(fields[19]) # clock ticks after boot
+        meta['uid'] = os.stat(path).st_uid
     except:
-        return "unknown"
+        # pid/task is gone
+        pass
+    return meta
+
+def new_result (pid):
+    # per pid counters, filled by a single worker and merged into the scan state once (see merge_result)
+    return {'pid' : pid, 'score' : 0, 'stats' : {}, 'extra' : {}, 'threads' : {}}
+
+def new_state ():
+    # counters of one scan, only touched by the thread running it ; frozen into an FDSnapshot at the end (see make_snapshot)
+    # pid_extra: pid -> comm, ppid, uid, num_threads, starttime (see get_meta), read once per pid
+    # pid_cgroup: pid -> cgroup path read by the --cgroup filter
+    # fd_type_cache: link target (path) -> FD type, shared libraries or log files open in many pids are stat'ed once per scan
+    # target_stats: top files report, target key (see target_key) -> [FD count, pid count] over all processes ;
+    # target_error: how much any FD count in target_stats may be too low (bounded mode)
+    return {'time' : time.time(), 'pid_score' : {}, 'pid_stats' : {}, 'pid_extra' : {}, 'pid_threads' : {}, 'pid_cgroup' : {},
+            'totals' : dict.fromkeys(fd_types, 0), 'fd_total' : None, 'estimated' : False, 'target_stats' : {}, 'target_error' : 0,
+            'timings' : {}, 'rescanned' : None, 'fd_type_cache' : {}}
 
-def get_ppid(pid):
-    # get parent pid
+def kcmp_files (pid1, pid2):
+    # True if both tasks share one FD table (CLONE_FILES), see kcmp(2) ; None if kcmp is not usable for them
+    if cfg['kcmp'] is False:
+        return None
     try:
-        f = open("/proc/"+pid+"/stat")
-        data = f.read().replace("\n", "").split()
-        f.close()
-        return data[3]
-    except:
-        return "unknown"
+        nr = kcmp_syscalls[platform.machine()]
+        ret = libc.syscall(nr, int(pid1), int(pid2), KCMP_FILES, 0, 0)
+    except (KeyError, AttributeError, OSError):
+        cfg['kcmp'] = False
+        return None
+    if ret < 0:
+        if ctypes.get_errno() in (errno.ENOSYS, errno.EPERM) and cfg['kcmp'] is None:
+            # no CONFIG_CHECKPOINT_RESTORE, or not allowed to ptrace ; don't keep trying
+            cfg['kcmp'] = False
+        return None
+    cfg['kcmp'] = True
+    return ret == 0
 
-def get_taskid(s):
-    """ example: /proc/10067/task/15335/fd/55 """
-    start = s.find('/task/') + 6
-    return s[start:s.find('/fd/', start)]
+def fd_table_fingerprint (path):
+    # FD numbers plus a few link targets ; equal for tasks that share one FD table
+    try:
+        names = sorted(os.listdir(path), key=int)
+        sample = [os.readlink(path + n) for n in names[::max(1, len(names) // 3)]]
+    except:
+        # task is gone or an FD was closed meanwhile ; such a table is scanned on its own
+        return None
+    return (tuple(names), tuple(sample))
 
-def get_stats (pid, path = ""):
-    # the main function to collect FD stats
-    if len(path) > 0:
-        path = path + "/fd/"
-        isProcess = False # means this is a task/thread associated with pid, e.g /proc/pid/task/*
-    else:
-        path = "/proc/" + pid + "/fd/"
-        isProcess = True
+def shared_fd_table (pid, tid, tables, conf = cfg):
+    # index of an already scanned table (in tables) the task shares, None if it has its own
+    path = conf['proc_root'] + "/" + pid + "/task/" + tid + "/fd/"
+    use_kcmp = conf['proc_root'] == '/proc'
+    fingerprint = None
+    for i, table in enumerate(tables):
+        if use_kcmp:
+            same = kcmp_files(table['tid'], tid)
+            if same is not None:
+                if same:
+                    return i
+                continue
+        # kcmp is not available, compare fingerprints
+        if fingerprint is None:
+            fingerprint = fd_table_fingerprint(path)
+            if fingerprint is None:
+                return None
+        if table.get('fingerprint') is None:
+            table['fingerprint'] = fd_table_fingerprint(table['path'])
+        if fingerprint == table['fingerprint']:
+            return i
+    return None
 
+def scan_fd_table (path, targets = None, cache = None, conf = cfg):
+    # readlink and classify all FDs in an fd directory ; returns (count, {fd type: count})
+    # FDs per link target are counted into targets if given (top files report), cache is the FD type cache of the scan
+    score = 0
+    stats = {}
     try:
         fobj1 = os.scandir(path)
     except:
         # pid is gone, skipping
-        return
+        return score, stats
 
     for item in fobj1:
 
@@ -184,77 +413,586 @@ def get_stats (pid, path = ""):
                 # the FD has been closed by the time we got here
                 continue
 
-            # store the stats into relevant dictionaries
-            pid_score[pid] += 1
-            if pid_stats.get(pid) is None:
-                pid_stats[pid] = {}
+            score += 1
+            fd_type = get_fd_type(ll, cache, conf)
+            stats[fd_type] = stats.get(fd_type, 0) + 1
+            if targets is not None:
+                key = target_key(ll)
+                targets[key] = targets.get(key, 0) + 1
+    return score, stats
+
+def target_key (s):
+    # compact key for the top files report: socket and pipe inodes as integers (pipes negative),
+    # other targets interned so every pid holding e.g. the same library or eventfd shares one string
+    try:
+        if s.startswith("socket:["):
+            return int(s[8:-1])
+        elif s.startswith("pipe:["):
+            return -int(s[6:-1])
+    except ValueError:
+        pass
+    return sys.intern(s)
+
+def key_to_target (key):
+    if isinstance(key, str):
+        return key
+    return "socket:[{}]".format(key) if key >= 0 else "pipe:[{}]".format(-key)
+
+def add_targets (state, targets, summary = False, error = 0, conf = cfg):
+    # fold FD counts per target of one process (or a summary from another process) into state['target_stats'] ;
+    # in bounded mode the map is pruned to the heavy hitters whenever it doubles (Misra-Gries): every count is
+    # lowered by the (top_files_max + 1)-th largest one and targets left at zero are dropped
+    target_stats = state['target_stats']
+    for key, cnt in targets.items():
+        fds, pids = cnt if summary else (cnt, 1)
+        v = target_stats.get(key)
+        if v is None:
+            target_stats[key] = [fds, pids]
+        else:
+            v[0] += fds
+            v[1] += pids
+    state['target_error'] += error
+
+    limit = conf['top_files_max']
+    if limit > 0 and len(target_stats) >= 2 * limit:
+        threshold = heapq.nlargest(limit + 1, (v[0] for v in target_stats.values()))[-1]
+        for key in [key for key, v in target_stats.items() if v[0] <= threshold]:
+            del target_stats[key]
+        for v in target_stats.values():
+            v[0] -= threshold
+        state['target_error'] += threshold
+
+def get_stats (pid, conf = cfg, cache = None, cgroups = None):
+    # the main function to collect FD stats ; counts go to a result local to the worker, not to the scan state
+    # (except for cache, the FD type cache of the scan, and cgroups, the cgroup paths the --cgroup filter already read)
+    # threads created with CLONE_FILES share the FD table of the process ; every distinct table is scanned once
+    # and its counts are attributed to every task sharing it, so the numbers are the same as scanning each task
+    res = new_result(pid)
+    path = conf['proc_root'] + "/" + pid + "/fd/"
+
+    # metadata is read once per process / task, not per FD
+    res['extra'] = get_meta(pid, "", conf)
+    if conf['group_by'] == 'cgroup':
+        res['extra']['cgroup'] = (cgroups or {}).get(pid) or get_cgroup(pid, conf)
+    # top files report: the process FD table only, tasks sharing it hold the same targets
+    if conf['top_files'] > 0:
+        res['targets'] = {}
+    score, stats = scan_fd_table(path, res.get('targets'), cache, conf)
+    add_counts(res, score, stats)
+
+    if not conf['scan_tasks']:
+        return res
 
-            if pid_extra.get(pid) is None:
-               pid_extra[pid] = {}
-            if isProcess:
-                pid_extra[pid]['comm'] = get_comm(pid)
-                pid_extra[pid]['ppid'] = get_ppid(pid)
+    # now the tasks (if any)
+    tmp_pids = get_pids(conf['proc_root'] + "/" + pid + "/task", conf)
 
-            # in case threads stats are requested too
-            if (not isProcess) and (cfg['show_threads']):
-                t_id = get_taskid(item.path)
+    # single threaded process would create /proc/pid/task/fd/ with the same pid as the process and have exact same FDs
+    # aka /prod/pid/task/pid ; this should be ignored
+    try:
+        tmp_pids.remove(pid)
+    except:
+        return res
+
+    tables = [{'tid' : pid, 'path' : path, 'score' : score, 'stats' : stats}]
+    for i in tmp_pids:
+        t_path = conf['proc_root'] + "/" + pid + "/task/" + i
+        shared = shared_fd_table(pid, i, tables, conf)
+        if shared is None:
+            t_score, t_stats = scan_fd_table(t_path + "/fd/", None, cache, conf)
+            tables.append({'tid' : i, 'path' : t_path + "/fd/", 'score' : t_score, 'stats' : t_stats})
+        else:
+            t_score, t_stats = tables[shared]['score'], tables[shared]['stats']
+        add_counts(res, t_score, t_stats)
+
+        # in case threads stats are requested too
+        if conf['show_threads'] and t_score > 0:
+            t_comm = get_meta(pid, t_path)['comm']
+            res['threads'][t_comm] = res['threads'].get(t_comm, 0) + t_score
+    res['fd_tables'] = len(tables)
+    return res
 
-                if pid_threads.get(pid) is None:
-                    pid_threads[pid] = {}
-                comm = get_comm(pid, "/proc/"+pid+"/task/"+t_id)
-                pid_threads[pid][comm] = pid_threads[pid].get(comm, 0)
-                pid_threads[pid][comm] += 1
+def add_counts (res, score, stats):
+    # add the counts of one FD table to the pid result
+    res['score'] += score
+    for fd_type, cnt in stats.items():
+        res['stats'][fd_type] = res['stats'].get(fd_type, 0) + cnt
 
-            fd_type = get_fd_type(ll)
+def merge_result (state, res, add_totals = True):
+    # merge one pid's counters into the scan state ; only called from the thread running the scan
+    pid = res['pid']
+    state['pid_score'][pid] = res['score']
+    state['pid_extra'][pid] = res['extra']
+    if res['stats']:
+        state['pid_stats'][pid] = res['stats']
+    if res['threads']:
+        state['pid_threads'][pid] = res['threads']
+    if add_totals:
+        totals = state['totals']
+        for fd_type, cnt in res['stats'].items():
+            totals[fd_type] = totals.get(fd_type, 0) + cnt
 
-            if pid_stats[pid].get(fd_type) is None:
-                pid_stats[pid][fd_type] = 0
-            pid_stats[pid][fd_type] += 1
-            totals[fd_type] += 1
+def scan_pids (state, pids, executor, conf = cfg):
+    # scan the pids with a thread pool ; workers return their own results, nothing shared is mutated
+    # targets (top files report) are folded into the state as results arrive instead of being kept per pid
+    results = []
+    for res in executor.map(get_stats, pids, itertools.repeat(conf), itertools.repeat(state['fd_type_cache']), itertools.repeat(state['pid_cgroup'])):
+        if 'targets' in res:
+            add_targets(state, res.pop('targets'), conf = conf)
+        results.append(res)
+    return results
 
-    if isProcess:
-        # now prepare to call itself for the tasks (if any)
-        tmp_pids = get_pids("/proc/" + pid + "/task")
+def init_worker (worker_cfg, workers):
+    # process pool initializer ; parse_args() / FDScanner settings are not inherited with spawn/forkserver
+    global worker_executor
+    cfg.update(worker_cfg)
+    worker_executor = concurrent.futures.ThreadPoolExecutor ( max_workers = max(1, workers) )
 
-        # single threaded process would create /proc/pid/task/fd/ with the same pid as the process and have exact same FDs
-        # aka /prod/pid/task/pid ; this should be ignored
+def scan_shard (pids, cgroups = None):
+    # process pool worker: results for a shard of pids, plus the targets seen in it
+    state = new_state()
+    state['pid_cgroup'].update(cgroups or {})
+    results = scan_pids(state, pids, worker_executor)
+    return results, state['target_stats'], state['target_error']
+
+def fd_size_works (conf = cfg):
+    # check once if st_size of /proc/<pid>/fd is the number of open FDs (Linux 6.2+) ; on a synthetic tree it is not
+    if conf['proc_root'] != '/proc':
+        return False
+    if cfg['fd_size'] is None:
+        cfg['fd_size'] = False
         try:
-            tmp_pids.remove(pid)
+            size = os.stat("/proc/self/fd").st_size
+            # listdir itself opens one more FD
+            cfg['fd_size'] = size > 0 and abs(len(os.listdir("/proc/self/fd")) - size) <= 1
         except:
-            return
-        
-        for i in tmp_pids:
-            get_stats (pid, "/proc/" + pid + "/task/" + i)
+            pass
+    return cfg['fd_size']
 
-def print_totals():
-    print ("Total number of open FDs: {}".format(sum(totals.values())))
-    for k in sorted(totals):
-        print ("\tTotal {} {}".format(k,totals[k]))
+def count_fds (pid, conf = cfg):
+    # number of open FDs of the process without reading the links
+    path = conf['proc_root'] + "/" + pid + "/fd"
+    try:
+        if fd_size_works(conf):
+            return os.stat(path).st_size
+        return len(os.listdir(path))
+    except:
+        # pid is gone
+        return 0
 
-def print_pids():
+def get_starttime (pid, conf = cfg):
+    # start time of the process (clock ticks after boot) ; a pid reused by a new process has a different one, 0 if gone
+    try:
+        f = open(conf['proc_root'] + "/" + pid + "/stat")
+        data = f.read()
+        f.close()
+        return int(data[data.rfind(')')+2:].split()[19])
+    except:
+        return 0
+
+def count_sample (pid, conf = cfg):
+    # watch mode: (number of open FDs, start time) of the process
+    return count_fds(pid, conf), get_starttime(pid, conf)
+
+def list_pids (conf = cfg, cgroups = None):
+    # watch mode and quick scan: all processes ; unlike get_pids the fd directories are not opened, count_fds reads them anyway
+    self_pid = str(os.getpid())
+    names = pid_filter_list(conf)
+    if names is None:
+        try:
+            names = [item.name for item in os.scandir(conf['proc_root']) if item.name.isdigit()]
+        except:
+            return []
+    return [name for name in names if (conf['include_self'] or name != self_pid) and pid_matches(name, conf, cgroups)]
+
+def get_nofile_limit (pid, conf = cfg):
+    # soft RLIMIT_NOFILE of the process from /proc/<pid>/limits ; None if unlimited or not readable
+    try:
+        f = open(conf['proc_root'] + "/" + pid + "/limits")
+        data = f.read()
+        f.close()
+    except:
+        # pid is gone
+        return None
+    for line in data.splitlines():
+        if line.startswith("Max open files"):
+            soft = line[len("Max open files"):].split()[0]
+            return int(soft) if soft.isdigit() else None
+    return None
+
+def scan_full (state, executor, procs_executor = None, conf = cfg):
+    # readlink and classify every FD of every (matching) pid ; the pids are sharded across procs_executor if given
+    start = time.monotonic()
+    pid_list = get_pids(None, conf, state['pid_cgroup'])
+    # ties in the pid listing keep the /proc order
+    state['pid_score'] = dict.fromkeys(pid_list, 0)
+    lap = time.monotonic()
+    state['timings']['list'] = lap - start
+
+    if procs_executor is not None and len(pid_list) > 1:
+        # shard the pids across processes (interleaved, big and small pids spread evenly),
+        # every process scans its shard with its share of the threads
+        procs = min(conf['procs'], len(pid_list))
+        shards = [pid_list[i::procs] for i in range(procs)]
+        # the cgroup paths read by the filter go along with their pids
+        cgroups = state['pid_cgroup']
+        shard_cgroups = [dict((pid, cgroups[pid]) for pid in shard if pid in cgroups) for shard in shards]
+        for results, targets, error in procs_executor.map(scan_shard, shards, shard_cgroups):
+            for res in results:
+                merge_result(state, res)
+            add_targets(state, targets, True, error, conf)
+    else:
+        for res in scan_pids(state, pid_list, executor, conf):
+            merge_result(state, res)
+    state['fd_total'] = sum(state['totals'].values())
+    state['timings']['scan'] = time.monotonic() - lap
+
+def scan_quick (state, executor, conf = cfg):
+    # two phase scan: 1) count FDs of every pid, 2) readlink and classify FDs of the top max_pids only
+    # type totals are exact for the top pids and extrapolated from a sample of the other pids
+    start = time.monotonic()
+    # the fd directories are not opened to list the pids, the count pass reads them anyway
+    pid_list = list_pids(conf, state['pid_cgroup'])
+    lap = time.monotonic()
+    state['timings']['list'] = lap - start
+
+    counts = dict((pid, cnt) for pid, cnt in zip(pid_list, executor.map(count_fds, pid_list, itertools.repeat(conf))) if cnt > 0)
+    # pids without FDs (or gone) are left out, like get_pids does
+    pid_list = list(counts)
+    state['pid_score'].update(counts)
+    state['fd_total'] = sum(counts.values())
+    start, lap = lap, time.monotonic()
+    state['timings']['count'] = lap - start
+
+    top = set(pid for pid, cnt in heapq.nlargest(conf['max_pids'], counts.items(), key=operator.itemgetter(1)))
+    rest = [pid for pid in pid_list if pid not in top]
+    sample = random.sample(rest, int(len(rest) * conf['sample'])) if conf['sample'] > 0 else []
+
+    results = scan_pids(state, list(top) + sample, executor, conf)
+    top_types = {}
+    sample_types = {}
+    sample_count = 0
+    for res in results:
+        if res['pid'] in top:
+            merge_result(state, res, False)
+            if not conf['scan_tasks']:
+                # keep the counted number, links we are not allowed to read are not classified but still open
+                state['pid_score'][res['pid']] = counts[res['pid']]
+            for fd_type, cnt in res['stats'].items():
+                top_types[fd_type] = top_types.get(fd_type, 0) + cnt
+        else:
+            sample_count += counts[res['pid']]
+            for fd_type, cnt in res['stats'].items():
+                sample_types[fd_type] = sample_types.get(fd_type, 0) + cnt
+
+    if conf['sample'] > 0:
+        rest_count = sum(counts[pid] for pid in rest)
+        scale = rest_count / sample_count if sample_count else 0
+        for fd_type in state['totals']:
+            state['totals'][fd_type] = top_types.get(fd_type, 0) + round(sample_types.get(fd_type, 0) * scale)
+        state['estimated'] = conf['sample'] < 1
+    else:
+        # no type totals at all
+        state['totals'] = {}
+    state['timings']['scan'] = time.monotonic() - lap
+
+def new_watch_state (conf = cfg):
+    # scan state kept between watch samples
+    # pid_history: pid -> ring buffer (deque) of (time, FD count, {fd type: count}) samples
+    # pid_limits: pid -> soft RLIMIT_NOFILE (None if unlimited or not readable), read once per pid
+    # pid_start: pid -> start time, a change means the pid was reused and its history is dropped
+    # type_history: ring buffer of (time, FD count, totals) samples for the whole system
+    state = new_state()
+    state.update({'pid_history' : {}, 'pid_limits' : {}, 'pid_start' : {}, 'type_history' : collections.deque(maxlen = conf['history'])})
+    return state
+
+def watch_sample (state, executor, procs_executor = None, conf = cfg):
+    # one watch sample: count FDs of all pids, readlink and classify only new pids and pids whose count changed
+    # (sharded across procs_executor if given) ; the pid list, metadata and per type counts of the other pids are reused
+    pid_score, pid_stats, pid_history = state['pid_score'], state['pid_stats'], state['pid_history']
+    state['time'] = time.time()
+    state['timings'] = {}
+    start = time.monotonic()
+    now = start
+    pid_list = list_pids(conf, state['pid_cgroup'])
+    # the watch state lives on, paths are stat'ed again every sample
+    state['fd_type_cache'] = {}
+    lap = time.monotonic()
+    state['timings']['list'] = lap - start
+
+    counts = {}
+    starts = {}
+    for pid, (cnt, starttime) in zip(pid_list, executor.map(count_sample, pid_list, itertools.repeat(conf))):
+        if cnt > 0:
+            counts[pid] = cnt
+            starts[pid] = starttime
+    start, lap = lap, time.monotonic()
+    state['timings']['count'] = lap - start
+
+    # pids that are gone (or have no FDs we can see), and pids reused by another process: they start over
+    pid_start = state['pid_start']
+    for pid in [pid for pid in pid_score if pid not in counts or pid_start.get(pid) != starts[pid]]:
+        for k in ('pid_score', 'pid_stats', 'pid_extra', 'pid_threads', 'pid_cgroup', 'pid_history', 'pid_limits', 'pid_start'):
+            state[k].pop(pid, None)
+    pid_start.update(starts)
+
+    changed = [pid for pid, cnt in counts.items() if pid_score.get(pid) != cnt]
+    if procs_executor is not None and len(changed) > 1:
+        procs = min(conf['procs'], len(changed))
+        shards = [changed[i::procs] for i in range(procs)]
+        results = itertools.chain.from_iterable(results for results, targets, error in procs_executor.map(scan_shard, shards))
+    else:
+        results = scan_pids(state, changed, executor, conf)
+    for res in results:
+        pid_stats.pop(res['pid'], None)
+        state['pid_threads'].pop(res['pid'], None)
+        merge_result(state, res, False)
+    # keep the counted number, links we are not allowed to read are not classified but still open
+    pid_score.update(counts)
+    state['fd_total'] = sum(counts.values())
+    state['rescanned'] = len(changed)
+
+    totals = state['totals']
+    for fd_type in totals:
+        totals[fd_type] = 0
+    for stats in pid_stats.values():
+        for fd_type, cnt in stats.items():
+            totals[fd_type] = totals.get(fd_type, 0) + cnt
+
+    for pid, cnt in counts.items():
+        if pid not in pid_history:
+            pid_history[pid] = collections.deque(maxlen = conf['history'])
+        # unchanged pids keep the same stats dictionary, a sample costs a tuple
+        pid_history[pid].append((now, cnt, pid_stats.get(pid, {})))
+    state['type_history'].append((now, state['fd_total'], dict(totals)))
+    state['timings']['scan'] = time.monotonic() - lap
+
+def get_growth (history, leak_samples):
+    # FD growth rate (per second) over the ring buffer, and if it looks like a leak:
+    # enough samples, the count never decreased and it grew in at least half of the intervals
+    t0, c0, _ = history[0]
+    t1, c1, _ = history[-1]
+    if t1 <= t0 or c1 <= c0:
+        return 0, False
+    rate = (c1 - c0) / (t1 - t0)
+    steps = [b[1] - a[1] for a, b in zip(history, itertools.islice(history, 1, None))]
+    leak = len(history) >= leak_samples and min(steps) >= 0 and 2 * sum(1 for d in steps if d > 0) >= len(steps)
+    return rate, leak
+
+def watch_growth (state, conf = cfg):
+    # growing pids of a watch state: pid -> Growth ; limits are read once per growing pid
+    growth = {}
+    for pid, history in state['pid_history'].items():
+        rate, leak = get_growth(history, conf['leak_samples'])
+        if rate <= 0:
+            continue
+        if pid not in state['pid_limits']:
+            state['pid_limits'][pid] = get_nofile_limit(pid, conf)
+        first, last = history[0][2], history[-1][2]
+        grown = dict((k, v - first.get(k, 0)) for k, v in last.items() if v > first.get(k, 0))
+        growth[pid] = Growth(rate, leak, state['pid_limits'][pid], types.MappingProxyType(grown))
+    return growth
+
+def make_snapshot (state, conf = cfg):
+    # freeze the counters of a scan ; nothing in the snapshot refers to dictionaries the scanner keeps changing
+    start = time.monotonic()
+    proxy = types.MappingProxyType
+    pids = {}
+    for pid, score in state['pid_score'].items():
+        meta = dict(state['pid_extra'].get(pid, {}))
+        if conf['group_by'] == 'cgroup' and meta.get('cgroup') is None:
+            # pids that were only counted (quick scan)
+            meta['cgroup'] = state['pid_cgroup'].get(pid) or get_cgroup(pid, conf)
+        threads = state['pid_threads'].get(pid)
+        pids[pid] = PidStats(score, proxy(dict(state['pid_stats'].get(pid, {}))), proxy(meta), None if threads is None else proxy(dict(threads)))
+
+    top_files = None
+    if conf['top_files'] > 0:
+        target_stats = state['target_stats']
+        if state['target_error']:
+            # pruning lowers the FD counts only ; every pid holds at least one FD, so the pid count is a lower bound too
+            items = ((key, (max(v[0], v[1]), v[1])) for key, v in target_stats.items())
+        else:
+            items = target_stats.items()
+        top = heapq.nlargest(conf['top_files'], items, key=lambda item: item[1])
+        top_files = TopFiles(tuple((key_to_target(key), v[0], v[1]) for key, v in top), len(target_stats), state['target_error'])
+
+    window = fd_delta = totals_delta = growth = None
+    if 'type_history' in state:
+        t0, total0, totals0 = state['type_history'][0]
+        window = state['type_history'][-1][0] - t0
+        fd_delta = state['fd_total'] - total0
+        totals_delta = proxy(dict((k, v - totals0.get(k, 0)) for k, v in state['totals'].items()))
+        growth = proxy(watch_growth(state, conf))
+
+    timings = dict(state['timings'])
+    timings['snapshot'] = time.monotonic() - start
+    return FDSnapshot(state['time'], proxy(pids), proxy(dict(state['totals'])), state['fd_total'], state['estimated'], top_files,
+                      proxy(timings), window, fd_delta, totals_delta, growth, state['rescanned'])
+
+class FDScanner:
+    """ reusable FD scanner ; the thread pool (and with procs > 1 the process pool) is kept between scans
+    scan() and scan_quick() work on their own counters and may be called repeatedly and from several threads ;
+    sample() (watch mode) keeps its counters between calls, concurrent calls are serialized
+    settings are the keys of cfg: FDScanner(cfg) for the command line ones, FDScanner(proc_root="/proc", max_workers=32) ...
+    """
+
+    def __init__ (self, conf = None, **options):
+        self.cfg = dict(cfg if conf is None else conf)
+        for k, v in options.items():
+            if k not in self.cfg:
+                raise TypeError("unknown FDScanner option " + k)
+            self.cfg[k] = v
+        self.executor = concurrent.futures.ThreadPoolExecutor ( max_workers = self.cfg['max_workers'] )
+        self.procs_executor = None
+        self.watch_state = None
+        self.lock = threading.Lock()
+        self.watch_lock = threading.Lock()
+
+    def process_pool (self):
+        # started on first use ; every worker process keeps its share of the threads (see init_worker)
+        conf = self.cfg
+        if conf['procs'] <= 1:
+            return None
+        with self.lock:
+            if self.procs_executor is None:
+                threads = max(conf['min_workers'], conf['max_workers'] // conf['procs'])
+                self.procs_executor = concurrent.futures.ProcessPoolExecutor ( max_workers = conf['procs'], initializer = init_worker, initargs = (conf, threads) )
+        return self.procs_executor
+
+    def scan (self):
+        """ full scan, every FD of every pid is read and classified """
+        state = new_state()
+        scan_full(state, self.executor, self.process_pool(), self.cfg)
+        return make_snapshot(state, self.cfg)
+
+    def scan_quick (self):
+        """ two phase scan: FD counts of all pids, types of the top max_pids (type totals are sampled, see cfg['sample']) """
+        state = new_state()
+        scan_quick(state, self.executor, self.cfg)
+        return make_snapshot(state, self.cfg)
+
+    def sample (self):
+        """ incremental watch sample: only pids whose FD count changed are read again ; growth is over cfg['history'] samples """
+        with self.watch_lock:
+            if self.watch_state is None:
+                self.watch_state = new_watch_state(self.cfg)
+            watch_sample(self.watch_state, self.executor, self.process_pool(), self.cfg)
+            return make_snapshot(self.watch_state, self.cfg)
+
+    def close (self):
+        self.executor.shutdown()
+        if self.procs_executor is not None:
+            self.procs_executor.shutdown()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close()
+
+def duration_to_str (seconds):
+    if seconds < 120:
+        return "{:.0f}s".format(seconds)
+    elif seconds < 7200:
+        return "{:.0f}m".format(seconds / 60)
+    elif seconds < 172800:
+        return "{:.1f}h".format(seconds / 3600)
+    return "{:.1f}d".format(seconds / 86400)
+
+def print_watch (snap, sample):
+    # watch mode output: totals with the change over the window, then pids ranked by FD growth rate
+    print ("================== {} : sample {}, window {} ==================".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snap.time)), sample, duration_to_str(snap.window)))
+    print ("Total number of open FDs: {} ({:+d}) in {} pids ; rescanned {} pids in {:.2f}s".format(snap.fd_total, snap.fd_delta, len(snap.pids), snap.rescanned, sum(snap.timings.values())))
+    for k in sorted(snap.totals):
+        print ("\tTotal {} {} ({:+d})".format(k, snap.totals[k], snap.totals_delta[k]))
+
+    if not snap.growth:
+        print ("No process is opening more FDs")
+        return
+
+    print_row(['Command', 'PID', 'FD count', 'FDs/min', 'Limit', 'Exhausted', 'Growing types'])
+    print()
+    for rate, leak, pid in heapq.nlargest(cfg['max_pids'], ((g.rate, g.leak, pid) for pid, g in snap.growth.items())):
+        cnt = snap.pids[pid].score
+        limit = snap.growth[pid].limit
+        if limit is None:
+            exhausted = "-"
+        elif cnt >= limit:
+            exhausted = "now"
+        else:
+            exhausted = "in " + duration_to_str((limit - cnt) / rate)
+
+        meta = snap.pids[pid].meta or get_meta(pid)
+        print_row([meta["comm"], pid, str(cnt), "{:+.1f}".format(rate * 60), str(limit or "-"), exhausted])
+        grown = snap.growth[pid].types
+        for kk in sorted(grown):
+            print ("{}(+{})".format(kk, grown[kk]), end=" ")
+        if leak:
+            print ("LEAK?", end="")
+        print()
+
+def watch (scanner, interval):
+    # sample every interval seconds ; counts are kept in ring buffers (cfg['history'] samples) to rank pids by growth
+    sample = 0
+    while True:
+        start = time.monotonic()
+        sample += 1
+        print_watch(scanner.sample(), sample)
+        sys.stdout.flush()
+        time.sleep (max(0, start + interval - time.monotonic()))
+
+def print_totals(snap):
+    # after a quick scan the count is exact, the types are estimated from the classified pids
+    print ("Total number of open FDs: {}".format(snap.fd_total))
+    for k in sorted(snap.totals):
+        print ("\tTotal {} {}{}".format(k, "~" if snap.estimated else "", snap.totals[k]))
+
+def print_groups(snap):
+    # FD counts and types summed per cgroup
+    groups = {}
+    for pid, p in snap.pids.items():
+        cgroup = p.meta.get('cgroup')
+        if cgroup is None:
+            # pid is gone
+            continue
+        group = groups.setdefault(cgroup, {'score' : 0, 'pids' : 0, 'stats' : {}})
+        group['score'] += p.score
+        group['pids'] += 1
+        for fd_type, n in p.stats.items():
+            group['stats'][fd_type] = group['stats'].get(fd_type, 0) + n
+
+    print_row(['FD count', 'PIDs', 'Cgroup'])
+    print()
+    for cgroup, group in heapq.nlargest(cfg['max_pids'], groups.items(), key=lambda item: item[1]['score']):
+        print_row([str(group['score']), str(group['pids']), cgroup])
+        print ('\n{:>28}{}'.format('', " ".join("{}({})".format(kk, group['stats'][kk]) for kk in sorted(group['stats']))))
+
+def print_pids(snap):
     print_row(['Command', 'PID', 'PPID', 'FD count', 'FD types'])
     print()
     i = 0
-    for pid,cnt in sort_dict_by_val(pid_score):
+    for pid,cnt in sort_dict_by_val(dict((pid, p.score) for pid, p in snap.pids.items())):
         i += 1
         # to limit output of pids
         if i > cfg['max_pids']:
             break
-        print_row([pid_extra[pid]["comm"], pid, pid_extra[pid]["ppid"], str(cnt)])
-        for kk in sorted(pid_stats[pid]):
-            print ("{}({})".format(kk,pid_stats[pid][kk]), end=" ")
+        p = snap.pids[pid]
+        meta = p.meta or get_meta(pid)
+        print_row([meta["comm"], pid, meta["ppid"], str(cnt)])
+        for kk in sorted(p.stats):
+            print ("{}({})".format(kk,p.stats[kk]), end=" ")
 
         # if requested to show tasks as well
         if cfg['show_threads']:
 
-            if pid_threads.get(pid) is None:
+            if p.threads is None:
                 pad_for_threads ("(no_task)")
                 print()
                 continue
 
             j = 0
             # thread command (comm) and thread score
-            for t_comm, t_score in sort_dict_by_val(pid_threads[pid]):
+            for t_comm, t_score in sort_dict_by_val(p.threads):
                 pad_for_threads ("|- {}({})".format(t_comm, t_score, end=""))
                 j += 1
                 # to limit the output of tasks/threads
@@ -263,17 +1001,43 @@ def print_pids():
 
         print()
 
-### end functions
+def print_top_files(snap):
+    # targets held open the most over all processes
+    top_files = snap.top_files
+    if top_files.error:
+        print ("Top {} of {} targets kept (--top-files-max {}) ; FD and PID counts may be low by up to {}".format(cfg['top_files'], top_files.distinct, cfg['top_files_max'], top_files.error))
+    else:
+        print ("Top {} of {} targets".format(cfg['top_files'], top_files.distinct))
+    print_row(['Type', 'FDs', 'PIDs', 'Target'])
+    print()
+    for target, fds, pids in top_files.top:
+        print_row([get_fd_type(target), str(fds), str(pids), target])
+        print()
 
-if __name__ == "__main__":
+def main():
     parse_args()
-    pid_list = get_pids()
+    with FDScanner(cfg) as scanner:
+        if cfg['watch'] is not None:
+            try:
+                watch(scanner, cfg['watch'])
+            except KeyboardInterrupt:
+                pass
+            return
+
+        if cfg['quick']:
+            snap = scanner.scan_quick()
+        else:
+            snap = scanner.scan()
 
-    # use concurrent executor to speed up the execution
-    with concurrent.futures.ThreadPoolExecutor ( max_workers = cfg['max_workers'] ) as executor:
-        task = {executor.submit(get_stats, I):I for I in pid_list}
-        for future in concurrent.futures.as_completed(task):
-            future.result()
+    print_totals(snap)
+    if cfg['group_by'] == 'cgroup':
+        print_groups(snap)
+    else:
+        print_pids(snap)
+    if cfg['top_files'] > 0:
+        print_top_files(snap)
+
+### end functions
 
-    print_totals()
-    print_pids()
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,12 @@
 Send/receive UDP multicast packets
 """
 
+import os
+import sys
+import time
+import errno
 import socket
+import selectors
 import struct
 import argparse
 
@@ -12,6 +17,24 @@ import argparse
 cfg = {} # configuration used in the script
 cfg['message'] = b'Hi, Multicast packet' # sample message 
 cfg['multicast_ttl'] = 2 # hop limit, https://www.tldp.org/HOWTO/Multicast-HOWTO-6.html 
+cfg['rate'] = None # load generator (--rate): packets per second ; None sends the message once
+cfg['size'] = None # load generator: UDP payload size in bytes (default: the header and the message)
+cfg['duration'] = None # load generator: seconds to send for ; None until interrupted
+cfg['max_burst'] = 64 # load generator: max packets sent back to back to catch up after a stall
+cfg['sndbuf'] = 4 << 20 # load generator: SO_SNDBUF
+cfg['report_interval'] = 1 # load generator and --stats: seconds between progress lines
+cfg['stats'] = False # receiver: count packets, rates, gaps and drops instead of printing every packet
+cfg['rcvbuf'] = None # receiver: SO_RCVBUF in bytes ; None keeps the system default
+cfg['ring'] = 64 # receiver --stats: packets are received into a ring of this many preallocated buffers
+cfg['reorder_window'] = 1 << 16 # receiver --stats: a sequence number further back than this is a restart of the sender
+cfg['groups'] = [] # multi group receiver (--groups): (group, port, interface or None) joined in one event loop
+cfg['summary_interval'] = 10 # multi group receiver: seconds between summaries
+
+# header of the load generator packets, in front of the message: magic, sequence number, send time (ns since the epoch)
+header = struct.Struct('!4sQQ')
+HEADER_MAGIC = b'PYMC'
+UDP_OVERHEAD = 42 # Ethernet, IPv4 and UDP headers, for the rate on the wire
+SO_RCVBUFFORCE = 33 # linux/socket.h, root only: not capped by net.core.rmem_max
 ### end variables 
 
 ### functions
@@ -19,16 +42,47 @@ cfg['multicast_ttl'] = 2 # hop limit, https://www.tldp.org/HOWTO/Multicast-HOWTO
 def parse_args ():
     parser = argparse.ArgumentParser (
         description = "Python multicast send/receive",
-        usage = "%(prog)s --send|--receive --ip=MCAST_IP --port=MCAST_PORT"
+        usage = "%(prog)s --send|--receive --ip=MCAST_IP --port=MCAST_PORT [--send --rate PPS [--size BYTES] [--duration S]] [--receive --stats [--rcvbuf BYTES]]\n"
+                "       %(prog)s --receive --groups GROUP:PORT[@IFACE],... [--groups-file FILE] [--interval S] [--rcvbuf BYTES]"
     )
-    parser.add_argument ("--ip", help="IP for Multicast Group", required=True)
-    parser.add_argument ("--port", type=int, help="Port for Multicast Group", required=True)
+    parser.add_argument ("--ip", help="IP for Multicast Group")
+    parser.add_argument ("--port", type=int, help="Port for Multicast Group")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument ("--send", help="Send multicast", action="store_true", default=False)
     group.add_argument ("--receive", help="Receive multicast", action="store_true", default=False)
     parser.add_argument ("--message", help="Message for Multicast Group (optional)", required=False)
+    parser.add_argument ("--rate", type=int, help="with --send: keep sending at PPS packets per second, each with a sequence number and send time header", metavar="PPS")
+    parser.add_argument ("--size", type=int, help="with --rate: UDP payload size in bytes (at least {}, default: the header and the message)".format(header.size), metavar="BYTES")
+    parser.add_argument ("--duration", type=float, help="with --rate: seconds to send for (default: until interrupted)", metavar="S")
+    parser.add_argument ("--stats", action="store_true", default=False, help="with --receive: print rates, lost / reordered packets (from the --rate headers) and kernel drops every second instead of the packets")
+    parser.add_argument ("--rcvbuf", type=int, help="with --receive: socket receive buffer size (SO_RCVBUF)", metavar="BYTES")
+    parser.add_argument ("--groups", action="append", default=[], help="with --receive: join all these groups in one process (comma separated GROUP:PORT[@IFACE], IFACE is a name or an address) and print per group rates every --interval seconds", metavar="GROUP:PORT[@IFACE],...")
+    parser.add_argument ("--groups-file", action="append", default=[], help="read --groups entries from FILE (whitespace or comma separated, # comments)", metavar="FILE")
+    parser.add_argument ("--interval", type=float, default=cfg['summary_interval'], help="with --groups: seconds between summaries (default {})".format(cfg['summary_interval']), metavar="S")
     args = parser.parse_args()
 
+    entries = [e for g in args.groups for e in g.split(',') if e.strip()]
+    for path in args.groups_file:
+        try:
+            with open(path) as f:
+                entries += [e for line in f for e in line.split('#', 1)[0].replace(',', ' ').split()]
+        except OSError as err:
+            parser.error(str(err))
+    if entries:
+        if not args.receive:
+            parser.error("--groups is for --receive")
+        if args.ip is not None or args.port is not None:
+            parser.error("give either --ip/--port or --groups")
+        if args.interval <= 0:
+            parser.error("--interval has to be positive")
+        try:
+            cfg['groups'] = list(dict.fromkeys(parse_group(e.strip()) for e in entries))
+        except ValueError as err:
+            parser.error(str(err))
+        cfg['summary_interval'] = args.interval
+    elif args.ip is None or args.port is None:
+        parser.error("--ip and --port are required (or --groups with --receive)")
+
     cfg['ip'] = args.ip
     cfg['port'] = args.port
 
@@ -38,6 +92,27 @@ def parse_args ():
         cfg['action'] = 'receive'
     if args.message is not None:
         cfg['message'] = bytes(args.message, 'utf-8')
+    if (args.stats or args.rcvbuf is not None) and not args.receive:
+        parser.error("--stats and --rcvbuf are for --receive")
+    if args.rcvbuf is not None and args.rcvbuf <= 0:
+        parser.error("--rcvbuf has to be positive")
+    cfg['stats'] = args.stats
+    cfg['rcvbuf'] = args.rcvbuf
+    if args.rate is None:
+        if args.size is not None or args.duration is not None:
+            parser.error("--size and --duration need --rate")
+        return
+    if not args.send:
+        parser.error("--rate is for --send")
+    if args.rate <= 0:
+        parser.error("--rate has to be positive")
+    if args.size is not None and not header.size <= args.size <= 65507:
+        parser.error("--size has to be between {} and 65507".format(header.size))
+    if args.duration is not None and args.duration <= 0:
+        parser.error("--duration has to be positive")
+    cfg['rate'] = args.rate
+    cfg['size'] = args.size
+    cfg['duration'] = args.duration
 
 def mc_send ():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -45,20 +120,332 @@ def mc_send ():
     sock.sendto(cfg['message'], (cfg['ip'], cfg['port']))
     sock.close()
 
+def rate_str (packets, payload, seconds):
+    """ achieved packet and bit rates (payload and on the wire) """
+    seconds = max(seconds, 1e-9)
+    return "{:.0f} pps, {:.2f} Mbit/s payload, {:.2f} Mbit/s on the wire".format(packets / seconds,
+        packets * payload * 8 / seconds / 1e6, packets * (payload + UDP_OVERHEAD) * 8 / seconds / 1e6)
+
+def mc_send_load ():
+    """ load generator: one socket, packets paced at cfg['rate'] per second ; every packet is the same preallocated
+    buffer with the header (sequence number, send time) packed into it in place """
+    rate = cfg['rate']
+    size = cfg['size'] or header.size + len(cfg['message'])
+    buf = bytearray(size)
+    body = cfg['message'] or b'\0'
+    # fill the rest with the message (repeated, cut at size)
+    buf[header.size:] = (body * ((size - header.size) // len(body) + 1))[:size - header.size]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, cfg['multicast_ttl'])
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, cfg['sndbuf'])
+    # connected: no address lookup per packet
+    sock.connect((cfg['ip'], cfg['port']))
+    send = sock.send
+    pack_into = header.pack_into
+    time_ns = time.time_ns
+    clock = time.perf_counter
+
+    seq = 0
+    errors = 0
+    start = clock()
+    stop = start + cfg['duration'] if cfg['duration'] else float('inf')
+    next_report = start + cfg['report_interval']
+    last_seq, last_time = 0, start
+    # schedule: packet base_seq + n is due at base + n / rate
+    base, base_seq = start, 0
+    try:
+        while True:
+            now = clock()
+            if now >= stop:
+                break
+            # packets due by now
+            due = int((now - base) * rate) + 1 - (seq - base_seq)
+            if due > cfg['max_burst']:
+                # behind after a stall: catch up at most max_burst back to back, move the schedule for the rest
+                base, base_seq = now - (cfg['max_burst'] - 1) / rate, seq
+                due = cfg['max_burst']
+            if due <= 0:
+                # sleep when the next packet is far enough, else spin: sleep() is too coarse at high rates
+                wait = base + (seq - base_seq) / rate - now
+                if wait > 0.0005:
+                    time.sleep(wait - 0.0003)
+                continue
+            for _ in range(due):
+                pack_into(buf, 0, HEADER_MAGIC, seq, time_ns())
+                try:
+                    send(buf)
+                except (BlockingIOError, InterruptedError):
+                    errors += 1
+                except OSError as err:
+                    # ENOBUFS: the interface queue is full
+                    if err.errno != errno.ENOBUFS:
+                        raise
+                    errors += 1
+                seq += 1
+            if now >= next_report:
+                print ("{:8.1f}s {:>12} packets  {}".format(now - start, seq, rate_str(seq - last_seq, size, now - last_time)))
+                sys.stdout.flush()
+                next_report += cfg['report_interval']
+                last_seq, last_time = seq, now
+    except KeyboardInterrupt:
+        pass
+    elapsed = clock() - start
+    sock.close()
+
+    achieved = seq / max(elapsed, 1e-9)
+    print ("Sent {} packets of {} bytes in {:.2f}s: {}".format(seq, size, elapsed, rate_str(seq, size, elapsed)))
+    print ("Target {} pps, {:.2f} Mbit/s payload: {:.0f} pps ({:.1f}%) short".format(rate, rate * size * 8 / 1e6,
+        max(0, rate - achieved), max(0, rate - achieved) * 100 / rate))
+    if errors:
+        print ("Send errors (socket or interface queue full, packets lost): {}".format(errors))
+
+def parse_group (entry):
+    """ "239.1.1.1:5000@eth0" (or @10.0.0.5, an address of the interface) -> (group, port, interface or None) """
+    addr, _, iface = entry.partition('@')
+    group, _, port = addr.rpartition(':')
+    try:
+        first = socket.inet_aton(group)[0]
+        port = int(port)
+    except (OSError, ValueError):
+        raise ValueError("{} is not GROUP:PORT[@IFACE]".format(entry))
+    if not 224 <= first <= 239 or not 0 < port < 65536:
+        raise ValueError("{} is not a multicast group and port".format(entry))
+    return group, port, iface or None
+
+def join_group (group, port, iface=None):
+    """ non-blocking socket bound to group:port (only its packets, also when several groups share a port) and joined
+    on iface (name or address, any interface if None) """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if cfg['rcvbuf']:
+        set_rcvbuf(sock, cfg['rcvbuf'])
+    sock.bind((group, port))
+    if iface is None:
+        mreq = struct.pack('4sl', socket.inet_aton(group), socket.INADDR_ANY)
+    else:
+        try:
+            # struct ip_mreqn: group, local address, interface index
+            mreq = struct.pack('4s4si', socket.inet_aton(group), socket.inet_aton('0.0.0.0'), socket.if_nametoindex(iface))
+        except OSError:
+            # an address of the interface: struct ip_mreq
+            mreq = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(iface))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sock.setblocking(False)
+    return sock
+
+def set_rcvbuf (sock, size):
+    """ SO_RCVBUF, above net.core.rmem_max when root ; returns the size the kernel gave (doubled for its bookkeeping) """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+def udp_drops_all ():
+    """ socket inode -> packets the kernel dropped (receive buffer full), from the drops column of /proc/net/udp """
+    drops = {}
+    try:
+        with open('/proc/net/udp') as f:
+            for line in f:
+                fields = line.split()
+                # sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref pointer drops
+                if len(fields) > 12 and fields[9].isdigit():
+                    drops[int(fields[9])] = int(fields[12])
+    except OSError:
+        pass
+    return drops
+
+def udp_drops (sock):
+    """ packets the kernel dropped for sock ; None if not found """
+    return udp_drops_all().get(os.fstat(sock.fileno()).st_ino)
+
+def new_stats ():
+    """ receiver counters: packets and bytes, and from the sequence numbers of the --rate headers lost (gaps not filled
+    later), reordered (late) and duplicate packets and sender restarts """
+    return {'packets' : 0, 'bytes' : 0, 'lost' : 0, 'reordered' : 0, 'duplicates' : 0, 'restarts' : 0, 'no_header' : 0}
+
+def count_seq (stats, senders, sender, seq):
+    """ account a sequence number of sender ; senders: sender -> [next expected sequence number, set of the missing
+    ones within reorder_window] ; gaps are counted as lost until the late packets arrive, a packet that was not
+    missing is a duplicate """
+    window = cfg['reorder_window']
+    state = senders.get(sender)
+    if state is None:
+        senders[sender] = [seq + 1, set()]
+        return
+    expected, missing = state
+    if seq == expected:
+        state[0] = seq + 1
+    elif seq > expected:
+        stats['lost'] += seq - expected
+        # only the last reorder_window of a gap can still arrive
+        missing.update(range(max(expected, seq - window), seq))
+        state[0] = seq + 1
+        if len(missing) > window:
+            # the ones too far back are lost for good
+            missing.difference_update([m for m in missing if m < seq - window])
+    elif expected - seq > window:
+        # the sender started again
+        stats['restarts'] += 1
+        state[0] = seq + 1
+        missing.clear()
+    elif seq in missing:
+        missing.discard(seq)
+        stats['reordered'] += 1
+        stats['lost'] -= 1
+    else:
+        stats['duplicates'] += 1
+
+def print_stats (stats, last, elapsed, seconds, drops):
+    """ one progress line: rates since last (a copy of stats at the previous line) and the totals """
+    packets = stats['packets'] - last['packets']
+    seconds = max(seconds, 1e-9)
+    print ("{:8.1f}s {:>9.0f} pps {:>9.2f} Mbit/s  packets {}  lost {}  reordered {}  duplicates {}  kernel drops {}".format(elapsed,
+        packets / seconds, (stats['bytes'] - last['bytes']) * 8 / seconds / 1e6, stats['packets'], stats['lost'],
+        stats['reordered'], stats['duplicates'], '-' if drops is None else drops))
+    sys.stdout.flush()
+
+def mc_receive_stats (sock):
+    """ stats only receiver: recv_into a ring of preallocated buffers (no allocation per packet), counters instead of
+    printing, a progress line every report_interval ; kernel drops are the ones since the socket was opened """
+    ring = [memoryview(bytearray(65536)) for _ in range(cfg['ring'])]
+    stats = new_stats()
+    last = dict(stats)
+    senders = {} # (address, port) -> next expected sequence number and the missing ones (see count_seq)
+    unpack_from = header.unpack_from
+    hsize = header.size
+    clock = time.monotonic
+    sock.settimeout(cfg['report_interval'])
+    recvfrom_into = sock.recvfrom_into
+    start = last_time = clock()
+    next_report = start + cfg['report_interval']
+    i = 0
+    try:
+        while True:
+            try:
+                n, sender = recvfrom_into(ring[i])
+            except socket.timeout:
+                n = 0
+            if n:
+                buf = ring[i]
+                i = (i + 1) % len(ring)
+                stats['packets'] += 1
+                stats['bytes'] += n
+                if n >= hsize and buf[:4] == HEADER_MAGIC:
+                    count_seq(stats, senders, sender, unpack_from(buf)[1])
+                else:
+                    stats['no_header'] += 1
+            now = clock()
+            if now >= next_report:
+                print_stats(stats, last, now - start, now - last_time, udp_drops(sock))
+                last = dict(stats)
+                last_time = now
+                next_report = max(next_report + cfg['report_interval'], now)
+    except KeyboardInterrupt:
+        pass
+    elapsed = clock() - start
+    drops = udp_drops(sock)
+    print ("Received {} packets ({} bytes) in {:.2f}s from {} senders, {} without a sequence header".format(stats['packets'],
+        stats['bytes'], elapsed, len(senders), stats['no_header']))
+    print ("Lost {}, reordered {}, duplicates {}, sender restarts {}, kernel drops {}".format(stats['lost'], stats['reordered'],
+        stats['duplicates'], stats['restarts'], '-' if drops is None else drops))
+
+def print_summary (groups, elapsed, seconds):
+    """ per group rates since the last summary and totals, groups is a list of (name, socket, stats, stats at the last summary) """
+    drops = udp_drops_all()
+    seconds = max(seconds, 1e-9)
+    total = new_stats()
+    total_drops = 0
+    print ("{:8.1f}s {:<32} {:>9} {:>10} {:>12} {:>8} {:>9} {:>10} {:>8}".format(elapsed, "group", "pps", "Mbit/s", "packets", "lost", "reordered", "duplicates", "drops"))
+    for name, sock, stats, last in groups:
+        d = drops.get(os.fstat(sock.fileno()).st_ino, 0)
+        total_drops += d
+        for k in total:
+            total[k] += stats[k]
+        print ("{:9} {:<32} {:>9.0f} {:>10.2f} {:>12} {:>8} {:>9} {:>10} {:>8}".format('', name, (stats['packets'] - last['packets']) / seconds,
+            (stats['bytes'] - last['bytes']) * 8 / seconds / 1e6, stats['packets'], stats['lost'], stats['reordered'], stats['duplicates'], d))
+        last.update(stats)
+    print ("{:9} {:<32} {:>9} {:>10} {:>12} {:>8} {:>9} {:>10} {:>8}".format('', "total ({} groups)".format(len(groups)), '', '',
+        total['packets'], total['lost'], total['reordered'], total['duplicates'], total_drops))
+    sys.stdout.flush()
+
+def mc_receive_groups ():
+    """ multi group receiver: a socket per group on one selector, each ready socket is drained with recvfrom_into
+    into a shared buffer ; per group counters (see new_stats) and a summary every summary_interval """
+    sel = selectors.DefaultSelector()
+    groups = []
+    for group, port, iface in cfg['groups']:
+        name = "{}:{}".format(group, port) + ("@" + iface if iface else "")
+        try:
+            sock = join_group(group, port, iface)
+        except OSError as err:
+            print ("Can not join {}: {}".format(name, err))
+            exit(2)
+        stats = new_stats()
+        # per group: the counters, the senders (see count_seq) and the socket
+        sel.register(sock, selectors.EVENT_READ, (stats, {}, sock))
+        groups.append((name, sock, stats, dict(stats)))
+    print ("Listening for multicast on {} groups".format(len(groups)))
+    buf = memoryview(bytearray(65536))
+    unpack_from = header.unpack_from
+    hsize = header.size
+    clock = time.monotonic
+    start = last_time = clock()
+    next_report = start + cfg['summary_interval']
+    try:
+        while True:
+            for key, _ in sel.select(max(0, next_report - clock())):
+                stats, senders, sock = key.data
+                recvfrom_into = sock.recvfrom_into
+                while True:
+                    try:
+                        n, sender = recvfrom_into(buf)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    stats['packets'] += 1
+                    stats['bytes'] += n
+                    if n >= hsize and buf[:4] == HEADER_MAGIC:
+                        count_seq(stats, senders, sender, unpack_from(buf)[1])
+                    else:
+                        stats['no_header'] += 1
+            now = clock()
+            if now >= next_report:
+                print_summary(groups, now - start, now - last_time)
+                last_time = now
+                next_report = max(next_report + cfg['summary_interval'], now)
+    except KeyboardInterrupt:
+        now = clock()
+        print_summary(groups, now - start, now - last_time)
+    finally:
+        for _, sock, _, _ in groups:
+            sock.close()
+        sel.close()
+
 def mc_receive ():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if cfg['rcvbuf']:
+        print ("Receive buffer: {} bytes".format(set_rcvbuf(sock, cfg['rcvbuf'])))
     sock.bind((cfg['ip'], cfg['port']))
     mreq = struct.pack('4sl', socket.inet_aton(cfg['ip']), socket.INADDR_ANY)
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    if cfg['stats']:
+        mc_receive_stats(sock)
+        return
     while True:
         print(sock.recv(10240))
 
 if __name__ == "__main__":
     parse_args()
     if cfg['action'] == 'send':
-        print ("Sending multicast to {}:{}". format(cfg['ip'],cfg['port']))
-        mc_send()
+        if cfg['rate']:
+            print ("Sending multicast to {}:{} at {} packets/s".format(cfg['ip'], cfg['port'], cfg['rate']))
+            mc_send_load()
+        else:
+            print ("Sending multicast to {}:{}". format(cfg['ip'],cfg['port']))
+            mc_send()
+    elif cfg['groups']:
+        mc_receive_groups()
     else:
         print ("Listening for multicast on {}:{}".format(cfg['ip'],cfg['port']))
         mc_receive()
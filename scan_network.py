@@ -4,36 +4,87 @@
 compare with: time nmap -sn -T5 --min-parallelism 100 -oG - 
 """
 
+import os
+import sys
+import errno
+import heapq
+import mmap
 import ipaddress
+import itertools
 import time
 import struct
 import select
 import socket
 import argparse
-import concurrent.futures
-import random
+import resource
+import selectors
+import collections
 
 # variables
-# where we would keep IPs
-ip_list = []
+# what to scan: (first, last) address ranges as integers, hosts are generated from them while scanning (see iter_hosts)
+targets = []
+excludes = []
 
-# cidr block
-cidr = ''
+# max probes in flight (sent, neither answered nor expired)
+window = 10000
 
-# how many threads we are going to use
-n_threads = 100
-timeout = 1 # seconds
+# TCP ports for the connect probe (--tcp) ; empty: ICMP echo
+tcp_ports = []
+
+# all probes go out of one ICMP socket, paced at rate echo requests per second
+rate = 1000
+timeout = 1 # seconds, until RTTs are measured (see probe_timeout)
 # the below values will take place when "--fast" argument is given
-fast_threads = 500
+fast_rate = 5000
 fast_timeout = 0.5
 # the below values will take place when "--ufast" argument is given ### be careful with these :)
-ufast_threads = 1000
+ufast_rate = 20000
 ufast_timeout = 0.3
 
+# timeouts follow the measured RTTs: rtt_mult x the rtt_percentile of the /24 once it has rtt_min_samples replies
+# (timeout before), kept between min_timeout and max_timeout
+rtt_mult = 3
+rtt_percentile = 95
+rtt_min_samples = 5
+rtt_keep = 64 # RTT samples kept per /24
+min_timeout = 0.01
+max_timeout = 3
+# hosts without an answer are probed again up to retries times, with the timeout doubled each time
+retries = 1
+backoff = 2
+
+# ICMP identifier of our echo requests, replies to other pingers on the host are ignored
+icmp_id = os.getpid() & 0xFFFF
+# socket buffers of the ICMP socket: replies of a fast scan arrive in bursts, and probes to hosts on the local
+# link stay queued (and charged to the socket) until the neighbour (ARP) resolution fails
+rcvbuf = 4 << 20
+sndbuf = 32 << 20
+SO_SNDBUFFORCE = 32 # linux/socket.h, root only: not capped by net.core.wmem_max
+SO_RCVBUFFORCE = 33
+
+# persistent scan state (--state DIR): one file per /16 with an Up and a changed bitmap and the last seen (Up) and
+# last probed times (epoch seconds) of its 65536 addresses, memory mapped ; created sparse, native byte order
+state_dir = None
+state_only = None # probe only hosts in one of these classes: up, down, changed, stale (see state_match)
+state_first = None # probe hosts in one of these classes first
+stale_age = 3600 # seconds since the last probe for a host to be stale
+diff_only = False # print only the hosts whose state changed since the last scan
+state_maps = {} # /16 (address >> 16) -> (mmap, last seen times, last probed times)
+STATE_MAGIC = b'SCANST01' + struct.pack('=II', 1, 0) # the version doubles as the byte order check
+STATE_UP = len(STATE_MAGIC)
+STATE_CHANGED = STATE_UP + 65536 // 8
+STATE_SEEN = STATE_CHANGED + 65536 // 8
+STATE_PROBED = STATE_SEEN + 4 * 65536
+STATE_SIZE = STATE_PROBED + 4 * 65536
+
 # counters for quick summary
 total_up = 0
 total_down = 0
 total_unknown = 0
+up_retry = 0 # of total_up, answered only a retry
+total_changed = 0 # with --state: hosts Up or Down since the last scan
+rtt_samples = {} # /24 (first three octets) -> deque of RTTs ; '' -> all replies
+rtt_timeouts = {} # /24 -> timeout from its samples, computed again when a sample comes in
 
 # end variables
 
@@ -44,73 +95,592 @@ def icmp_checksum(data):
     x = (x >> 16) + (x & 0xFFFF)
     return struct.pack('<H', ~x & 0xFFFF)
 
-def icmp_ping(addr, timeout=1, count=1, data=b''):
-    global total_up, total_down, total_unknown
-# from https://gist.github.com/pyos/10980172
-    with socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP) as conn:
-        payload = struct.pack('!HH', random.randrange(0, 65536), count) + data
+def open_icmp_socket():
+    """ one non-blocking ICMP socket for all probes: raw (root / CAP_NET_RAW) or, without privileges,
+    a ping socket (allowed by net.ipv4.ping_group_range); returns (socket, is raw) """
+    try:
+        conn = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        raw = True
+    except PermissionError:
+        conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        raw = False
+    conn.setblocking(False)
+    for force, opt, size in ((SO_RCVBUFFORCE, socket.SO_RCVBUF, rcvbuf), (SO_SNDBUFFORCE, socket.SO_SNDBUF, sndbuf)):
         try:
-            conn.connect((addr, 1))
-        except:
-            print ("Please check network address " + addr)
-            return False
+            conn.setsockopt(socket.SOL_SOCKET, force, size)
+        except OSError:
+            # not root, the kernel caps it at net.core.[rw]mem_max
+            conn.setsockopt(socket.SOL_SOCKET, opt, size)
+    return conn, raw
+
+def add_rtt(addr, rtt):
+    """ RTT sample of a reply from addr, for its /24 and for all replies """
+    for key in (addr.rsplit('.', 1)[0], ''):
+        samples = rtt_samples.get(key)
+        if samples is None:
+            samples = rtt_samples[key] = collections.deque(maxlen=rtt_keep)
+        samples.append(rtt)
+        rtt_timeouts.pop(key, None)
+
+def rtt_timeout(key):
+    """ timeout from the RTTs of a /24 ('': all replies), None while there are not enough samples """
+    t = rtt_timeouts.get(key)
+    if t is None:
+        samples = rtt_samples.get(key)
+        if samples is None or len(samples) < rtt_min_samples:
+            return None
+        samples = sorted(samples)
+        t = samples[min(len(samples) - 1, len(samples) * rtt_percentile // 100)] * rtt_mult
+        t = rtt_timeouts[key] = min(max_timeout, max(min_timeout, t))
+    return t
+
+def probe_timeout(addr, attempt, timeout=1):
+    """ timeout of a probe to addr: from the RTTs of its /24, timeout until the /24 has enough replies (the RTTs of
+    other subnets say nothing about a slower one) ; retries (attempt > 0) back off """
+    t = rtt_timeout(addr.rsplit('.', 1)[0]) or timeout
+    return min(max_timeout, t * backoff ** attempt)
+
+def rtt_summary():
+    """ RTT percentiles of all replies, for the totals """
+    samples = sorted(rtt_samples.get('', ()))
+    if not samples:
+        return "RTT: no replies"
+    return "RTT (last {} replies) p50: {:.2f} ms, p{}: {:.2f} ms, max: {:.2f} ms".format(len(samples),
+        samples[len(samples) // 2] * 1000, rtt_percentile, samples[min(len(samples) - 1, len(samples) * rtt_percentile // 100)] * 1000, samples[-1] * 1000)
+
+def state_map(a):
+    """ state of the /16 of address a (integer): (mmap, last seen times, last probed times), the file is
+    created on first use """
+    block = a >> 16
+    state = state_maps.get(block)
+    if state is None:
+        path = os.path.join(state_dir, "{}.{}.state".format(block >> 8, block & 0xFF))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
         try:
-            conn.sendall(b'\x08\0' + icmp_checksum(b'\x08\0\0\0' + payload) + payload)
-        except:
-            total_unknown += 1
-        start = time.time()
+            size = os.fstat(fd).st_size
+            if size == 0:
+                # sparse, the bitmaps and times of addresses never probed stay zero
+                os.ftruncate(fd, STATE_SIZE)
+                os.pwrite(fd, STATE_MAGIC, 0)
+            elif size != STATE_SIZE or os.pread(fd, len(STATE_MAGIC), 0) != STATE_MAGIC:
+                print (path + " is not a scan state file")
+                exit(2)
+            mm = mmap.mmap(fd, STATE_SIZE)
+        finally:
+            os.close(fd)
+        view = memoryview(mm)
+        state = state_maps[block] = (mm, view[STATE_SEEN:STATE_PROBED].cast('I'), view[STATE_PROBED:].cast('I'))
+    return state
+
+def close_state():
+    """ write back and unmap the state files """
+    for mm, seen, probed in state_maps.values():
+        seen.release()
+        probed.release()
+        mm.flush()
+        mm.close()
+    state_maps.clear()
+
+def host_state(a):
+    """ stored state of address a (integer): (Up, changed at the last probe, last seen, last probed) """
+    mm, seen, probed = state_map(a)
+    i = a & 0xFFFF
+    bit = 1 << (i & 7)
+    return bool(mm[STATE_UP + (i >> 3)] & bit), bool(mm[STATE_CHANGED + (i >> 3)] & bit), seen[i], probed[i]
 
-        while select.select([conn], [], [], max(0, start + timeout - time.time()))[0]:
-            data = conn.recv(65536)
-            if len(data) < 20 or len(data) < struct.unpack_from('!xxH', data)[0]:
+def record_state(a, up):
+    """ store the result of a probe to address a (integer), returns the state before (see host_state) """
+    mm, seen, probed = state_map(a)
+    before = host_state(a)
+    i = a & 0xFFFF
+    bit = 1 << (i & 7)
+    now = int(time.time())
+    # a host never seen is no change when it is Down
+    for off, flag in ((STATE_UP, up), (STATE_CHANGED, up != before[0])):
+        mm[off + (i >> 3)] = mm[off + (i >> 3)] | bit if flag else mm[off + (i >> 3)] & ~bit
+    probed[i] = now
+    if up:
+        seen[i] = now
+    return before
+
+def state_match(addr, classes, now):
+    """ address in one of the classes: up / down (at the last probe), changed (at the last probe),
+    stale (not probed for stale_age seconds, or never) """
+    up, changed, seen, probed = host_state(struct.unpack('!I', socket.inet_aton(addr))[0])
+    return (('up' in classes and up) or ('down' in classes and probed and not up) or
+            ('changed' in classes and changed) or ('stale' in classes and now - probed >= stale_age))
+
+def select_hosts(targets, excludes, only=None, first=None):
+    """ hosts to scan with --state: only the ones in the classes of only, the ones in the classes of first
+    before the others (two passes over the ranges, still generated lazily) ; the class of a host is read
+    before it is probed, the hosts of the first pass are remembered in a bitmap per /16 and skipped in the second """
+    now = time.time()
+    done = {} # /16 -> bitmap of the hosts scanned in the first pass
+    def hosts(classes):
+        for addr in iter_hosts(targets, excludes):
+            a = struct.unpack('!I', socket.inet_aton(addr))[0]
+            bits = done.get(a >> 16)
+            if bits is not None and bits[(a & 0xFFFF) >> 3] & (1 << (a & 7)):
+                continue
+            if only and not state_match(addr, only, now):
                 continue
-            if data[20:] == b'\0\0' + icmp_checksum(b'\0\0\0\0' + payload) + payload:
-                total_up += 1
-                print (addr + " is Up")
-                return
+            if classes is not None:
+                if not state_match(addr, classes, now):
+                    continue
+                if bits is None:
+                    bits = done[a >> 16] = bytearray(65536 // 8)
+                bits[(a & 0xFFFF) >> 3] |= 1 << (a & 7)
+            yield addr
+    if not first:
+        return hosts(None)
+    # the second pass starts once the first is exhausted, after all its hosts are marked
+    return itertools.chain(hosts(first), hosts(None))
+
+def report(addr, up):
+    """ Up / Down result of a host ; with --state it is stored and changes since the last scan are
+    noted (only those are printed with --diff) """
+    global total_up, total_down, total_changed
+    if up:
+        total_up += 1
+    else:
         total_down += 1
-        print (addr + " is Down")
+    if state_dir is None:
+        print (addr + (" is Up" if up else " is Down"))
+        return
+    was_up, _, seen, probed = record_state(struct.unpack('!I', socket.inet_aton(addr))[0], up)
+    # a host never seen is no change when it is Down
+    if up == was_up:
+        if not diff_only:
+            print (addr + (" is Up" if up else " is Down"))
+        return
+    total_changed += 1
+    if up:
+        print (addr + " is Up" + (" (was Down)" if probed else " (new)"))
+    else:
+        print (addr + " is Down (was Up, last seen {})".format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seen))))
+
+def host_up(addr, attempt, rtt):
+    global up_retry
+    add_rtt(addr, rtt)
+    if attempt:
+        up_retry += 1
+    report(addr, True)
+
+def read_replies(conn, raw, inflight, seqs):
+    """ drain the socket: echo replies matching a probe (source address, identifier, sequence) of a host without
+    an answer yet mark it Up ; a late reply to an earlier try counts as well """
+    while True:
+        try:
+            data, peer = conn.recvfrom(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        # a raw socket gets the IP header too (and every ICMP packet of the host), a ping socket just ICMP of its own
+        off = (data[0] & 0x0F) * 4 if raw else 0
+        if len(data) < off + 8 or data[off] != 0:
+            continue
+        ident, seq = struct.unpack_from('!HH', data, off + 4)
+        if raw and ident != icmp_id:
+            continue
+        sent = seqs.pop((peer[0], seq), None)
+        if sent is not None:
+            probe = inflight.pop(peer[0])
+            for s in probe[2]:
+                seqs.pop((peer[0], s), None)
+            host_up(peer[0], probe[1], time.monotonic() - sent)
+
+def ping_hosts(hosts, timeout=1, rate=1000, window=10000, data=b'', retries=2):
+    """ ICMP echo to every address in hosts (any iterable, consumed lazily) from a single socket:
+    requests are paced at rate per second with at most window hosts in flight, replies are matched in one
+    receive loop (see read_replies) and probes without a reply expire from a heap of deadlines (see probe_timeout) ;
+    hosts without a reply are probed again up to retries times before they are Down """
+    global total_unknown
+    conn, raw = open_icmp_socket()
+    hosts = iter(hosts)
+    backlog = [] # (address, attempt) to send again, the socket buffer was full
+    again = collections.deque() # (address, attempt) of hosts to retry, sent before new hosts
+    inflight = {} # address -> [last sequence, attempt, sequences sent] for hosts without an answer
+    seqs = {} # (address, sequence) -> send time, every probe of the hosts in inflight
+    deadlines = [] # heap of (deadline, address, sequence)
+    seq = 0
+    interval = 1.0 / rate
+    next_send = time.monotonic()
+    sending = True
+
+    with conn:
+        while sending or backlog or inflight:
+            now = time.monotonic()
+            # after a stall do not send a burst to catch up
+            next_send = max(next_send, now - 10 * interval)
+            while (sending or backlog or again) and next_send <= now:
+                if backlog:
+                    addr, attempt = backlog.pop()
+                elif again:
+                    addr, attempt = again.popleft()
+                elif len(inflight) < window:
+                    addr, attempt = next(hosts, None), 0
+                    if addr is None:
+                        sending = False
+                        continue
+                else:
+                    break
+                if attempt and addr not in inflight:
+                    # a late reply to an earlier try came in before the retry went out
+                    continue
+                seq = (seq + 1) & 0xFFFF
+                payload = struct.pack('!HHd', icmp_id, seq, now) + data
+                try:
+                    conn.sendto(b'\x08\0' + icmp_checksum(b'\x08\0\0\0' + payload) + payload, (addr, 0))
+                except (BlockingIOError, InterruptedError):
+                    backlog.append((addr, attempt))
+                    break
+                except OSError as err:
+                    if err.errno == errno.ENOBUFS:
+                        backlog.append((addr, attempt))
+                        break
+                    probe = inflight.pop(addr, None)
+                    for s in probe[2] if probe else ():
+                        seqs.pop((addr, s), None)
+                    print ("Please check network address {} ({})".format(addr, err.strerror))
+                    total_unknown += 1
+                    continue
+                probe = inflight.get(addr)
+                if probe is None:
+                    probe = inflight[addr] = [seq, attempt, []]
+                probe[0] = seq
+                probe[1] = attempt
+                probe[2].append(seq)
+                seqs[(addr, seq)] = now
+                heapq.heappush(deadlines, (now + probe_timeout(addr, attempt, timeout), addr, seq))
+                next_send += interval
 
-def cidr_to_list (s):
+            # sleep until the next send or the next deadline, whatever comes first, unless replies arrive
+            wake = [deadlines[0][0]] if deadlines else []
+            if backlog or again or (sending and len(inflight) < window):
+                wake.append(next_send if next_send > now else now + interval)
+            wait = max(0, min(wake) - time.monotonic()) if wake else 0
+            if select.select([conn], [], [], wait)[0]:
+                read_replies(conn, raw, inflight, seqs)
+
+            now = time.monotonic()
+            while deadlines and deadlines[0][0] <= now:
+                _, addr, s = heapq.heappop(deadlines)
+                probe = inflight.get(addr)
+                # answered hosts were already removed from inflight, earlier tries were retried already
+                if probe is None or probe[0] != s:
+                    continue
+                if probe[1] < retries:
+                    again.append((addr, probe[1] + 1))
+                    continue
+                del inflight[addr]
+                for s in probe[2]:
+                    seqs.pop((addr, s), None)
+                report(addr, False)
+            # results stream out as they come, also into a pipe
+            sys.stdout.flush()
+
+def tcp_result(sock, probe, err, remaining, probes, retries=2):
+    """ one connect probe (address, port, attempt, send time) finished: the host is Up on a SYN-ACK (connected)
+    or a RST (refused) ; a timed out port is tried again up to retries times, the host is Down (or unknown if
+    the network is unreachable) once every port of it failed """
+    global total_unknown
+    addr, port, attempt, sent = probe
+    # close with a RST, no FIN handshake and no TIME_WAIT on our side
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    sock.close()
+    if addr not in remaining:
+        # already answered on another port
+        return
+    if err in (0, errno.ECONNREFUSED):
+        del remaining[addr]
+        host_up(addr, attempt, time.monotonic() - sent)
+        return
+    if err == errno.ETIMEDOUT and attempt < retries:
+        probes.appendleft((addr, port, attempt + 1))
+        return
+    remaining[addr] -= 1
+    if remaining[addr] == 0:
+        del remaining[addr]
+        if err == errno.ENETUNREACH:
+            print ("Please check network address {} ({})".format(addr, os.strerror(err)))
+            total_unknown += 1
+        else:
+            report(addr, False)
+
+def fd_window(window):
+    """ every pending connect holds an FD: raise the soft RLIMIT_NOFILE towards the hard limit if needed
+    and cap the window by it """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = window + 64
+    if soft != resource.RLIM_INFINITY and soft < want:
+        new = want if hard == resource.RLIM_INFINITY else min(want, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new, hard))
+            soft = new
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return window
+    return max(1, min(window, soft - 64))
+
+def tcp_probe_hosts(hosts, ports, timeout=1, rate=1000, window=10000, retries=2):
+    """ TCP connect probe, needs no privileges: non-blocking connects to the ports of every host multiplexed on one
+    selector, paced at rate connects per second with at most window pending (see tcp_result for Up / Down and
+    probe_timeout for the timeouts) """
+    sel = selectors.DefaultSelector()
+    window = fd_window(window)
+    hosts = iter(hosts)
+    probes = collections.deque() # (address, port, attempt) not started yet, the next host is taken when it is empty
+    remaining = {} # address -> ports not failed yet, for hosts without an answer
+    deadlines = [] # heap of (deadline, n, socket)
+    n = 0
+    interval = 1.0 / rate
+    next_send = time.monotonic()
+    sending = True
+
+    while sending or probes or remaining:
+        now = time.monotonic()
+        # after a stall do not send a burst to catch up
+        next_send = max(next_send, now - 10 * interval)
+        while (sending or probes) and next_send <= now and len(sel.get_map()) < window:
+            if not probes:
+                addr = next(hosts, None)
+                if addr is None:
+                    sending = False
+                    break
+                remaining[addr] = len(ports)
+                probes.extend((addr, port, 0) for port in ports)
+            addr, port, attempt = probes.popleft()
+            if addr not in remaining:
+                # the host answered on another port
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            err = sock.connect_ex((addr, port))
+            if err in (errno.EAGAIN, errno.ENOBUFS):
+                # out of local ports or buffers, try again later
+                sock.close()
+                probes.appendleft((addr, port, attempt))
+                break
+            next_send += interval
+            if err == errno.EINPROGRESS:
+                sel.register(sock, selectors.EVENT_WRITE, (addr, port, attempt, now))
+                heapq.heappush(deadlines, (now + probe_timeout(addr, attempt, timeout), n, sock))
+                n += 1
+            else:
+                tcp_result(sock, (addr, port, attempt, now), err, remaining, probes, retries)
+
+        wake = [deadlines[0][0]] if deadlines else []
+        if (sending or probes) and len(sel.get_map()) < window:
+            wake.append(next_send if next_send > now else now + interval)
+        wait = max(0, min(wake) - time.monotonic()) if wake else 0
+        if sel.get_map():
+            events = sel.select(wait)
+        else:
+            time.sleep(wait)
+            events = []
+        for key, _ in events:
+            sock = key.fileobj
+            sel.unregister(sock)
+            tcp_result(sock, key.data, sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR), remaining, probes, retries)
+
+        now = time.monotonic()
+        while deadlines and deadlines[0][0] <= now:
+            _, _, sock = heapq.heappop(deadlines)
+            # finished probes are closed already
+            if sock.fileno() != -1:
+                probe = sel.unregister(sock).data
+                tcp_result(sock, probe, errno.ETIMEDOUT, remaining, probes, retries)
+        sys.stdout.flush()
+    sel.close()
+
+def parse_ports (s):
+    """ "22,80,8000-8010" -> ports, in the given order """
+    ports = []
+    try:
+        for p in s.split(','):
+            if '-' in p:
+                lo, hi = p.split('-', 1)
+                ports += range(int(lo), int(hi) + 1)
+            elif p.strip():
+                ports.append(int(p))
+    except ValueError:
+        ports = []
+    if not ports or min(ports) < 1 or max(ports) > 65535:
+        print ("--tcp needs a list of ports between 1 and 65535, e.g. 22,80,443 or 8000-8010")
+        exit(2)
+    return list(dict.fromkeys(ports))
+
+def parse_target (s):
+    """ CIDR (a.b.c.d/nn), range (a.b.c.d-e.f.g.h or a.b.c.d-h) or a single address -> (first, last) integers """
     try:
-        obj = ipaddress.ip_network(s)
+        if '-' in s:
+            first, last = s.split('-', 1)
+            first = int(ipaddress.IPv4Address(first.strip()))
+            last = last.strip()
+            if last.isdigit():
+                # last octet only
+                if int(last) > 255:
+                    raise ValueError(s + " is not a valid range")
+                last = (first & 0xFFFFFF00) | int(last)
+            else:
+                last = int(ipaddress.IPv4Address(last))
+            if last < first:
+                raise ValueError(s + " is not a valid range")
+            return first, last
+        obj = ipaddress.IPv4Network(s)
     except ValueError as err:
         print (err)
         exit(2)
-    for i in obj.hosts():
-        ip_list.append(str(i))
+    first, last = int(obj.network_address), int(obj.broadcast_address)
+    # the same hosts as ipaddress .hosts(): no network and broadcast address, except in /31 and /32
+    if obj.prefixlen < 31:
+        first, last = first + 1, last - 1
+    return first, last
+
+def read_targets (path):
+    """ targets from a file, whitespace or comma separated, # comments """
+    try:
+        with open(path) as f:
+            return [t for line in f for t in line.split('#', 1)[0].replace(',', ' ').split()]
+    except OSError as err:
+        print (err)
+        exit(2)
+
+def merge_ranges (ranges):
+    """ sorted, non overlapping [first, last] ranges """
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+def iter_hosts (targets, excludes=()):
+    """ addresses of the targets minus the excludes, generated from the integer ranges one by one
+    (overlapping targets are scanned once; memory does not depend on how many hosts there are) """
+    excludes = merge_ranges(excludes)
+    j = 0
+    for first, last in merge_ranges(targets):
+        n = first
+        while n <= last:
+            while j < len(excludes) and excludes[j][1] < n:
+                j += 1
+            if j < len(excludes) and excludes[j][0] <= n:
+                # skip the excluded range
+                n = excludes[j][1] + 1
+                continue
+            stop = min(last, excludes[j][0] - 1) if j < len(excludes) else last
+            for a in range(n, stop + 1):
+                yield socket.inet_ntoa(struct.pack('!I', a))
+            n = stop + 1
 
 ### end functions
 
 def parse_args ():
-    global cidr, n_threads, timeout, max_n_threads, min_timeout
+    global targets, excludes, rate, timeout, window, tcp_ports, retries
+    global state_dir, state_only, state_first, stale_age, diff_only
     """ Argument parser"""
     parser = argparse.ArgumentParser (
         description = "Quick network CIDR scanner",
-        usage = "%(prog)s CIDR (e.g. abc.def.gh.yz/nn)"
+        usage = "%(prog)s CIDR|RANGE [CIDR|RANGE ...] (e.g. abc.def.gh.yz/nn abc.def.gh.10-20) [--exclude CIDR|RANGE,...] [--file FILE]"
     )
-    parser.add_argument ("cidr", help="CIDR block")
+    parser.add_argument ("cidr", nargs="*", help="CIDR blocks, ranges (a.b.c.d-e.f.g.h or a.b.c.d-h) or addresses")
+    parser.add_argument ("--file", action="append", default=[], help="read targets from FILE (whitespace or comma separated, # comments)")
+    parser.add_argument ("--exclude", action="append", default=[], help="do not scan these (comma separated CIDR blocks, ranges or addresses)")
+    parser.add_argument ("--exclude-file", action="append", default=[], help="read excludes from FILE")
+    parser.add_argument ("--window", type=int, default=window, help="max probes in flight (default {})".format(window))
     parser.add_argument ("--fast", help="make it faster", action="store_true", default=False)
     parser.add_argument ("--ufast", help="ultra fast", action="store_true", default=False)
+    parser.add_argument ("--rate", type=int, help="echo requests (or connects) per second (default {}, --fast {}, --ufast {})".format(rate, fast_rate, ufast_rate))
+    parser.add_argument ("--timeout", type=float, help="seconds to wait for an answer until RTTs are measured, then the timeouts follow the RTTs of each /24 (default {}, --fast {}, --ufast {})".format(timeout, fast_timeout, ufast_timeout))
+    parser.add_argument ("--retries", type=int, default=retries, help="probe hosts without an answer again this many times, waiting {}x longer each time (default {})".format(backoff, retries))
+    parser.add_argument ("--state", metavar="DIR", help="keep the Up / Down state and last seen times of the hosts in DIR (a file per /16) and note the changes since the last scan")
+    parser.add_argument ("--diff", action="store_true", default=False, help="with --state: print only the hosts that changed since the last scan")
+    parser.add_argument ("--only", metavar="CLASSES", help="with --state: scan only the hosts in one of CLASSES, comma separated up, down, changed, stale")
+    parser.add_argument ("--prioritize", metavar="CLASSES", help="with --state: scan the hosts in one of CLASSES first (e.g. changed,stale)")
+    parser.add_argument ("--stale", type=int, default=stale_age, help="with --state: seconds since the last probe for a host to be stale, never probed hosts are stale too (default {})".format(stale_age))
+    parser.add_argument ("--tcp", metavar="PORTS", help="TCP connect probe instead of ICMP echo, a host is Up if any of PORTS (e.g. 22,80,443) answers (SYN-ACK or RST); no root needed")
 
     args = parser.parse_args()
-    cidr = args.cidr
+    names = list(args.cidr)
+    for path in args.file:
+        names += read_targets(path)
+    if not names:
+        parser.error("nothing to scan, give a CIDR block, a range or --file")
+    targets = [parse_target(t) for t in names]
+    names = [t for e in args.exclude for t in e.split(',') if t.strip()]
+    for path in args.exclude_file:
+        names += read_targets(path)
+    excludes = [parse_target(t.strip()) for t in names]
+    if args.window <= 0:
+        print ("--window has to be positive")
+        exit(2)
+    window = args.window
+    if args.tcp is not None:
+        tcp_ports = parse_ports(args.tcp)
 
     if args.fast == True:
-        n_threads = fast_threads
+        rate = fast_rate
         timeout = fast_timeout
     elif args.ufast == True:
-        n_threads = ufast_threads
+        rate = ufast_rate
         timeout = ufast_timeout
+    if args.rate is not None:
+        if args.rate <= 0:
+            print ("--rate has to be positive")
+            exit(2)
+        rate = args.rate
+    if args.timeout is not None:
+        if args.timeout <= 0:
+            print ("--timeout has to be positive")
+            exit(2)
+        timeout = args.timeout
+    if args.retries < 0:
+        print ("--retries can not be negative")
+        exit(2)
+    retries = args.retries
+
+    if args.state is None:
+        if args.diff or args.only or args.prioritize:
+            parser.error("--diff, --only and --prioritize need --state")
+    else:
+        try:
+            os.makedirs(args.state, exist_ok=True)
+        except OSError as err:
+            print (err)
+            exit(2)
+        state_dir = args.state
+        diff_only = args.diff
+        stale_age = args.stale
+        classes = []
+        for arg in (args.only, args.prioritize):
+            names = set(c.strip() for c in arg.split(',') if c.strip()) if arg else None
+            if names is not None and not names <= {'up', 'down', 'changed', 'stale'}:
+                parser.error("classes are up, down, changed and stale")
+            classes.append(names)
+        state_only, state_first = classes
 
 if __name__ == "__main__":
     parse_args()
-    cidr_to_list(cidr)
 
-# use concurrent executor to speed up the execution
-    with concurrent.futures.ThreadPoolExecutor ( max_workers = n_threads ) as executor:
-        task = {executor.submit(icmp_ping, I, timeout):I for I in ip_list}
-        for future in concurrent.futures.as_completed(task):
-            future.result()
+# one socket, paced sends and a single receive loop for all the hosts ; hosts are generated as the window allows
+    if state_dir is not None:
+        hosts = select_hosts(targets, excludes, state_only, state_first)
+    else:
+        hosts = iter_hosts(targets, excludes)
+    try:
+        if tcp_ports:
+            tcp_probe_hosts(hosts, tcp_ports, timeout, rate, window, retries=retries)
+        else:
+            ping_hosts(hosts, timeout, rate, window, retries=retries)
+    except PermissionError:
+        print ("ICMP sockets need root (CAP_NET_RAW) or a group in net.ipv4.ping_group_range")
+        exit(2)
+    finally:
+        close_state()
 
     print ("Total up: {}\nTotal down: {}\nTotal unknown: {}".format(str(total_up), str(total_down), str(total_unknown)))
+    print ("Up on the first try: {}\nUp after a retry: {}\n{}".format(str(total_up - up_retry), str(up_retry), rtt_summary()))
+    if state_dir is not None:
+        print ("Changed since the last scan: {}".format(str(total_changed)))